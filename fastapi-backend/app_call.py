@@ -1,5 +1,6 @@
 import os
 import json
+import uuid
 import base64
 import asyncio
 import logging
@@ -12,8 +13,14 @@ from fastapi.websockets import WebSocketDisconnect
 from twilio.twiml.voice_response import VoiceResponse, Connect, Say, Stream
 from dotenv import load_dotenv
 from fastapi.middleware.cors import CORSMiddleware
-from appointment_call import AppointmentWorkflow
-from storage import CompanyDetailsStorage, Details
+from contextlib import asynccontextmanager
+from llm_gateway import get_gateway, run_background
+from realtime_pool import RealtimePool
+from startup import components
+from tenants import DEFAULT_TENANT_ID, UnknownTenantError
+from voice_tools import TOOLS, ToolCalls
+from voice_gate import VOICE_GATE, VoiceGate
+from relay import CallRelay, pump
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -22,33 +29,10 @@ logger = logging.getLogger(__name__)
 # Configuration
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')  # requires OpenAI Realtime API Access
 PORT = int(os.getenv('PORT', 5050))
-appointment_workflow = AppointmentWorkflow()
 
-storage = CompanyDetailsStorage()
-
-company_details = storage.load_details()
-
-print("--------#########--------")
-print(f"Company Name: {company_details.company_name}")
-print(f"Services: {company_details.services}")
-print("--------#########--------")
-
-
-SYSTEM_MESSAGE = f"""You are Donna, an AI receptionist for the company: {company_details.company_name}, which provides services: {company_details.services}.
-        Here is a short description of the company: {company_details.short_description} and some context: {company_details.summary}.
-        Your job is to:
-        - Politely engage with the client and answer their questions regarding the company and services.
-        - If they want to book an appointment, obtain their name, availability, and service/work required. Ask one question at a time.
-        Do not ask for other contact information, and do not check availability, assume we are free. Ensure the conversation remains friendly and professional, 
-        and guide the user to provide these details naturally. If necessary, ask follow-up questions to gather the required information.
-        While replying to user queries, make sure to provide as concise and to-the-point information as possible.
-        """
-
-print("--------#########--------")
-print(SYSTEM_MESSAGE)
-print("--------#########--------")
 
 VOICE = "alloy"
+REALTIME_MODEL = "gpt-4o-realtime-preview-2024-10-01"
 
 LOG_EVENT_TYPES = [
     'response.content.done', 'rate_limits.updated', 'response.done',
@@ -56,10 +40,28 @@ LOG_EVENT_TYPES = [
     'input_audio_buffer.speech_started', 'session.created'
 ]
 
-myapp = FastAPI()
-
-# Session management
-sessions: Dict[str, dict] = {}
+async def open_realtime_connection():
+    """Open a realtime API websocket with the tenant-independent session settings applied"""
+    openai_ws = await websockets.connect(
+        f'wss://api.openai.com/v1/realtime?model={REALTIME_MODEL}',
+        extra_headers={
+            "Authorization": f"Bearer {OPENAI_API_KEY}",
+            "OpenAI-Beta": "realtime=v1"
+        })
+    await send_session_update(openai_ws)
+    return openai_ws
+
+# Pre-connected sessions so the TLS handshake and session setup happen
+# during the TwiML greeting rather than after the caller starts talking
+realtime_pool = RealtimePool(open_realtime_connection)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await realtime_pool.start()
+    yield
+    await realtime_pool.stop()
+
+myapp = FastAPI(lifespan=lifespan)
 
 class CustomerDetails(BaseModel):
     customerName: str
@@ -79,10 +81,23 @@ myapp.add_middleware(
 async def index_page():
     return {"message": "Twilio Media Stream Server is running!"}
 
+@myapp.get("/realtime-pool", response_class=JSONResponse)
+async def realtime_pool_stats():
+    return realtime_pool.stats()
+
+# Relay queues of the calls in progress, by session id
+active_relays: Dict[str, CallRelay] = {}
+
+@myapp.get("/relay-queues", response_class=JSONResponse)
+async def relay_queue_stats():
+    return {session_id: relay.stats() for session_id, relay in active_relays.items()}
+
 @myapp.api_route("/incoming-call", methods=["GET", "POST"])
 async def incoming_call(request: Request):
     """ Handle incoming call and return TwiML response to connect to Media Stream """
-    
+    # Have a realtime session ready by the time the greeting is over
+    realtime_pool.request_warm()
+
     response = VoiceResponse()
     response.say(
         "Please wait while we connect your call to the AI voice assistant"
@@ -90,25 +105,42 @@ async def incoming_call(request: Request):
     response.pause(length=1)
     response.say("O.K. you can start talking!")
 
+    # Twilio sends the dialled number as `To`; stream URLs can't carry a
+    # query string, so the tenant travels as a custom stream parameter
+    params = await request.form() if request.method == "POST" else request.query_params
+    try:
+        tenant_id = components.get("tenants").resolve(params.get("To", ""))
+    except UnknownTenantError as e:
+        logger.warning(str(e))
+        response = VoiceResponse()
+        response.say("Sorry, this number is not in service.")
+        response.hangup()
+        return HTMLResponse(content=str(response), media_type="application/xml")
+
     host = request.url.hostname
     connect = Connect()
-    connect.stream(url=f'wss://{host}/call/media-stream')
+    stream = connect.stream(url=f'wss://{host}/call/media-stream')
+    stream.parameter(name="tenant", value=tenant_id)
     response.append(connect)
 
     return HTMLResponse(content=str(response), media_type="application/xml")
 
-async def twilio_to_openai(websocket: WebSocket, openai_ws, session):
-    """Send audio data from Twilio to OpenAI"""
+async def twilio_to_openai(websocket: WebSocket, openai_ws, session, relay: CallRelay,
+                           gate: Optional[VoiceGate] = None):
+    """Queue audio data from Twilio for OpenAI"""
     try:
         async for message in websocket.iter_text():
             data = json.loads(message)
 
             if data['event'] == 'media' and not openai_ws.closed:
-                audio_append = {
-                    "type": "input_audio_buffer.append",
-                    "audio": data['media']['payload']
-                }
-                await openai_ws.send(json.dumps(audio_append))
+                # The gate holds back silence beyond its hangover
+                payload = data['media']['payload']
+                for audio in (gate.process(payload) if gate else [payload]):
+                    audio_append = {
+                        "type": "input_audio_buffer.append",
+                        "audio": audio
+                    }
+                    await relay.to_openai.put(json.dumps(audio_append), audio=True)
             
             elif data['event'] == 'start':
                 session["stream_sid"] = data['start']['streamSid']
@@ -121,14 +153,26 @@ async def twilio_to_openai(websocket: WebSocket, openai_ws, session):
         logger.error(f"Error in twilio_to_openai: {e}")
         raise
 
-async def openai_to_twilio(websocket: WebSocket, openai_ws, session, session_id):
-    """Send audio data from OpenAI to Twilio"""
+async def openai_to_twilio(websocket: WebSocket, openai_ws, session, session_id, tenant, relay: CallRelay):
+    """Handle OpenAI events and queue audio data for Twilio"""
+    # Tool calls run beside the relay so audio keeps flowing meanwhile
+    tool_calls = ToolCalls(openai_ws, tenant)
     try:
         async for openai_message in openai_ws:
             response = json.loads(openai_message)
 
             if response['type'] == 'session.updated':
                 logger.info("Session updated successfully: %s", response)
+
+            elif response['type'] == 'rate_limits.updated':
+                # Shown on /llm-gateway, calls are not held for realtime quota
+                get_gateway().observe_rate_limits(REALTIME_MODEL, response['rate_limits'])
+
+            elif response['type'] == 'response.output_item.done':
+                tool_calls.output_item_done(response)
+
+            elif response['type'] == 'response.done':
+                tool_calls.response_done(response)
                 
             print("------------------")
             print("Response:",response)
@@ -140,14 +184,17 @@ async def openai_to_twilio(websocket: WebSocket, openai_ws, session, session_id)
             
             elif response["type"] == "response.done" and response["response"]["status"] == "completed":
                 logger.info("Response: %s", response)
+                # Function call items have no content, only spoken replies go in the transcript
                 agent_message = next(
                     (content["transcript"] 
-                     for content in response["response"]["output"][0]["content"] 
+                     for item in response["response"]["output"]
+                     for content in item.get("content", [])
                      if "transcript" in content),
-                    "Agent message not found"
+                    None
                 )
-                session["transcript"] += f"Agent: {agent_message}\n"
-                logger.info(f"Agent ({session_id}): {agent_message}")
+                if agent_message is not None:
+                    session["transcript"] += f"Agent: {agent_message}\n"
+                    logger.info(f"Agent ({session_id}): {agent_message}")
             
             elif response["type"] == "response.audio.delta" and response.get("delta"):
                 try:
@@ -160,16 +207,30 @@ async def openai_to_twilio(websocket: WebSocket, openai_ws, session, session_id)
                             "payload": audio_payload
                         }
                     }
-                    await websocket.send_json(audio_delta)
+                    await relay.to_twilio.put(audio_delta, audio=True)
                 except Exception as e:
                     logger.error(f"Error processing audio data: {e}")
 
     except Exception as e:
         logger.error(f"Error in openai_to_twilio: {e}")
         raise
-
-async def send_session_update(openai_ws):
-    """Send session update to OpenAI WebSocket."""
+    finally:
+        tool_calls.cancel()
+
+async def wait_for_stream_start(websocket: WebSocket) -> dict:
+    """Read Twilio messages until the 'start' event and return its payload"""
+    async for message in websocket.iter_text():
+        data = json.loads(message)
+        if data['event'] == 'start':
+            return data['start']
+    raise WebSocketDisconnect()
+
+async def send_session_update(openai_ws, instructions: Optional[str] = None):
+    """Send session update to OpenAI WebSocket.
+
+    Pooled connections are configured without instructions; the tenant's
+    instructions are sent once the call has claimed the connection.
+    """
     session_update = {
         "type": "session.update",
         "session": {
@@ -177,14 +238,17 @@ async def send_session_update(openai_ws):
             "input_audio_format": "g711_ulaw",
             "output_audio_format": "g711_ulaw",
             "voice": VOICE,
-            "instructions": SYSTEM_MESSAGE,
             "modalities": ["text", "audio"],
             "temperature": 0.8,
             "input_audio_transcription": {
                 "model": "whisper-1"
-            }
+            },
+            "tools": TOOLS,
+            "tool_choice": "auto"
         }
     }
+    if instructions is not None:
+        session_update["session"]["instructions"] = instructions
     logger.info('Sending session update: %s', json.dumps(session_update))
     await openai_ws.send(json.dumps(session_update))
 
@@ -194,49 +258,62 @@ async def media_stream(websocket: WebSocket):
     await websocket.accept()
     logger.info("Client Connected")
 
-    session_id = f"session_{asyncio.get_event_loop().time()}"
-    session = sessions.get(session_id, {"transcript": "", "stream_id": None})
-    sessions[session_id] = session
+    # Loop time is not unique across workers, use a random id instead
+    session_id = f"session_{uuid.uuid4().hex}"
+    # A call stays on the worker holding its websocket, so its state is local
+    session = {"transcript": "", "stream_sid": None}
     
     openai_ws = None
+    tenant = None
+    gate = VoiceGate() if VOICE_GATE else None
+    relay = active_relays[session_id] = CallRelay()
+    # Claimed right away: on a pool miss the connection opens while we wait for Twilio's start event
+    claim_task = asyncio.create_task(realtime_pool.claim())
 
     try:
-        # Connect to OpenAI WebSocket and send session update
-        async with websockets.connect(
-            'wss://api.openai.com/v1/realtime?model=gpt-4o-realtime-preview-2024-10-01',
-            extra_headers={
-                "Authorization": f"Bearer {OPENAI_API_KEY}",
-                "OpenAI-Beta": "realtime=v1"
-            }) as openai_ws:
-            await send_session_update(openai_ws)
-
-            # Create tasks for both directions of communication
-            twilio_task = asyncio.create_task(twilio_to_openai(websocket, openai_ws, session))
-            openai_task = asyncio.create_task(openai_to_twilio(websocket, openai_ws, session, session_id))
-
-            # Wait for either task to complete (which would happen on disconnect)
-            done, pending = await asyncio.wait(
-                [twilio_task, openai_task],
-                return_when=asyncio.FIRST_COMPLETED
-            )
-
-            # Cancel the other task
-            for task in pending:
-                task.cancel()
-                try:
-                    await task
-                except asyncio.CancelledError:
-                    pass
-
-            # Re-raise any exceptions from the completed tasks
-            for task in done:
-                try:
-                    await task
-                except WebSocketDisconnect:
-                    raise  # Re-raise to trigger the finally block
-                except Exception as e:
-                    logger.error(f"Task error: {e}")
-                    raise
+        # The start event names the tenant, which decides the instructions
+        start = await wait_for_stream_start(websocket)
+        session["stream_sid"] = start['streamSid']
+        session["tenant_id"] = start.get('customParameters', {}).get('tenant', DEFAULT_TENANT_ID)
+        logger.info(f"Incoming stream has started {session['stream_sid']} for tenant {session['tenant_id']}")
+        tenant = await asyncio.to_thread(components.get("tenants").get, session["tenant_id"])
+
+        # Take a pre-connected OpenAI WebSocket and send the tenant's session update
+        openai_ws = await claim_task
+        await send_session_update(openai_ws, tenant.voice_instructions)
+
+        # A reader and a writer task per direction, joined by bounded queues,
+        # so a slow peer never stalls reading from the other side
+        tasks = [
+            asyncio.create_task(twilio_to_openai(websocket, openai_ws, session, relay, gate)),
+            asyncio.create_task(pump(relay.to_openai, openai_ws.send)),
+            asyncio.create_task(openai_to_twilio(websocket, openai_ws, session, session_id, tenant, relay)),
+            asyncio.create_task(pump(relay.to_twilio, websocket.send_json)),
+        ]
+
+        # Wait for any task to complete (which would happen on disconnect or overflow)
+        done, pending = await asyncio.wait(
+            tasks,
+            return_when=asyncio.FIRST_COMPLETED
+        )
+
+        # Cancel the other tasks
+        for task in pending:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+        # Re-raise any exceptions from the completed tasks
+        for task in done:
+            try:
+                await task
+            except WebSocketDisconnect:
+                raise  # Re-raise to trigger the finally block
+            except Exception as e:
+                logger.error(f"Task error: {e}")
+                raise
 
     except WebSocketDisconnect:
         logger.info("WebSocket disconnected")
@@ -244,21 +321,33 @@ async def media_stream(websocket: WebSocket):
         logger.error(f"WebSocket error: {e}")
     finally:
         # Cleanup
+        if openai_ws is None:
+            claim_task.cancel()
+            try:
+                openai_ws = await claim_task
+            except (asyncio.CancelledError, Exception):
+                pass
         if openai_ws and not openai_ws.closed:
             await openai_ws.close()
         
         logger.info("Client Disconnected")
+        if gate:
+            logger.info(f"Voice gate ({session_id}): {gate.stats()}")
+        active_relays.pop(session_id, None)
+        logger.info(f"Relay queues ({session_id}): {relay.stats()}")
         logger.info("Session Transcript:")
         logger.info(session["transcript"])
-        
-        # Remove session from sessions dict
-        if session_id in sessions:
-            del sessions[session_id]
 
         # Optional: Send transcript to webhook
         # You could add webhook functionality here to send the transcript
         # to your external system
-        result = appointment_workflow.process_transcript_and_send_to_webhook(session["transcript"])
+        appointment_workflow = components.get("appointment_workflow")
+        # On the background pool: the gateway may queue this call for minutes
+        result = await run_background(
+            appointment_workflow.process_transcript_and_send_to_webhook,
+            session["transcript"], webhook_url=tenant.config.webhook_url if tenant else None,
+            appointments=tenant.appointments if tenant else None,
+        )
         print(result)
 
 if __name__ == "__main__":
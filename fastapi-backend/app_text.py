@@ -1,17 +1,23 @@
-from fastapi import FastAPI, Request, Response
+from fastapi import BackgroundTasks, FastAPI, Request, Response
 from twilio.twiml.messaging_response import MessagingResponse
 from fastapi.middleware.cors import CORSMiddleware
 import logging
-from storage import VectorStore
-from ai_output import Output
 import os
 import uvicorn
 import asyncio
-from typing import Dict
-from datetime import datetime
+import time
+import uuid
+from typing import Dict, Optional, Set, Tuple, TYPE_CHECKING
 from dotenv import load_dotenv
 from contextlib import asynccontextmanager
-from appointment_call import AppointmentWorkflow
+from llm_gateway import GatewayBusyError, run_background
+from memory import ConversationMemory, MemoryCompactor
+from session_store import StateBackend
+from tenants import UnknownTenantError, appointments_for
+from startup import components
+
+if TYPE_CHECKING:
+    from ai_output import Output
 
 load_dotenv()
 
@@ -21,100 +27,178 @@ logging.basicConfig(
 )
 
 logger = logging.getLogger(__name__)
-appointment_workflow = AppointmentWorkflow()
+
+# Longest a message may hold its sender's session, a crashed worker's lock expires after it
+TEXT_SESSION_LOCK_TTL = float(os.getenv("TEXT_SESSION_LOCK_TTL", 60))
 
 class SessionManager:
-    def __init__(self):
-        self.current_session: Dict[str, any] = None
-        self.timeout = 60  # seconds
-        self.timeout_task: asyncio.Task = None
-        self.transcript = []
-        self.last_response = None
+    """Per-sender WhatsApp sessions kept in a shared StateBackend.
+
+    Nothing about a conversation lives in this process: any worker can pick
+    up the next message of a conversation. The inactivity timeout is decided
+    from the stored `last_activity`, so a timer firing on one worker leaves a
+    session alone if another worker has renewed it in the meantime.
+    """
+
+    def __init__(self, backend: StateBackend, timeout: int = 60):
+        self.backend = backend
+        self.timeout = timeout  # seconds
+        # Keep expired sessions around a while so a late timer or the next
+        # message can still hand the transcript to the appointment workflow
+        self.retention = timeout + 300
+        self.timeout_tasks: Dict[str, asyncio.Task] = {}
+        # Transcripts of stale sessions being processed after the reply
+        self.ending_tasks: Set[asyncio.Task] = set()
+
+    def _key(self, sender: str) -> str:
+        return f"text:{sender}"
+
+    @asynccontextmanager
+    async def lock(self, sender: str):
+        """Hold the sender's session for a read-modify-write, across workers.
+
+        Messages from one sender are handled one at a time, so each sees the
+        previous exchange instead of overwriting it.
+        """
+        key = f"lock:{self._key(sender)}"
+        token = {"owner": uuid.uuid4().hex}
+        while not self.backend.add(key, token, TEXT_SESSION_LOCK_TTL):
+            await asyncio.sleep(0.05)
+        try:
+            yield
+        finally:
+            # Only our own lock, it may have expired and been taken since
+            self.backend.delete_if(key, token)
+
+    def _cancel_timeout(self, sender: str):
+        task = self.timeout_tasks.pop(sender, None)
+        if task and task is not asyncio.current_task():
+            task.cancel()
 
     async def cleanup(self):
-        """Cleanup current session and task"""
+        """Cancel this worker's timers, sessions themselves stay in the backend"""
         logger.info("Starting cleanup of session...")
-        if self.timeout_task:
+        for sender in list(self.timeout_tasks):
+            task = self.timeout_tasks.pop(sender)
             try:
-                self.timeout_task.cancel()
-                await self.timeout_task
+                task.cancel()
+                await task
             except asyncio.CancelledError:
                 pass
             except Exception as e:
                 logger.error(f"Error cancelling timeout task: {e}")
-        
-        self.current_session = None
-        self.transcript = []
-        self.last_response = None
+        # Let transcripts already taken from the backend reach the workflow
+        if self.ending_tasks:
+            await asyncio.gather(*self.ending_tasks, return_exceptions=True)
         logger.info("Cleanup completed")
 
-    async def create_session(self) -> bool:
-        """Create a new session"""
-        is_new_session = self.current_session is None or not self.current_session.get('is_active', False)
+    async def create_session(self, sender: str, tenant_id: str) -> Tuple[dict, bool]:
+        """Load the sender's session or create a new one"""
+        self._cancel_timeout(sender)
+        now = time.time()
 
+        session = self.backend.get(self._key(sender), ttl=self.retention)
+        if session and now - session['last_activity'] >= self.timeout:
+            # Expired while no timer was watching it (e.g. its worker restarted).
+            # Its transcript is processed after the reply, not before it
+            stale = self.backend.take(self._key(sender))
+            if stale:
+                task = asyncio.create_task(self._finish_session(stale))
+                self.ending_tasks.add(task)
+                task.add_done_callback(self.ending_tasks.discard)
+            session = None
 
-        if self.timeout_task:
-            self.timeout_task.cancel()
+        is_new_session = session is None
+        if is_new_session:
+            session = {
+                'tenant_id': tenant_id,
+                'start_time': now,
+                'message_count': 0,
+                'transcript': [],
+                'memory': ConversationMemory().to_dict(),
+                'last_response': None,
+            }
+        session['last_activity'] = now
+
+        logger.info(f"Session {'created' if is_new_session else 'renewed'}")
+        return session, is_new_session
+
+    def save_session(self, sender: str, session: dict):
+        """Write the session back to the shared backend"""
+        self.backend.set(self._key(sender), session, self.retention)
+
+    async def end_session(self, sender: str, idle_for: Optional[float] = None) -> Optional[str]:
+        """End the sender's session, with idle_for only if it has been idle that long"""
+        self._cancel_timeout(sender)
+        # take() is atomic, so only one worker processes a given transcript.
+        # Under the lock, so a message being answered can't write it back after
+        async with self.lock(sender):
+            if idle_for is not None:
+                # A message may have renewed it while we waited for the lock
+                session = self.backend.get(self._key(sender))
+                if session and time.time() - session['last_activity'] < idle_for:
+                    return None
+            session = self.backend.take(self._key(sender))
+        if session:
+            return await self._finish_session(session)
+        return "No active session to end"
+
+    async def _finish_session(self, session: dict) -> str:
+        """Hand a session taken from the backend to the appointment workflow"""
+        session_duration = time.time() - session['start_time']
+        messages_exchanged = session['message_count']
+
+        summary = (
+            "🔚 Session ended\n"
+            f"Duration: {int(session_duration)} seconds\n"
+            f"Messages exchanged: {messages_exchanged}"
+        )
         
-        self.current_session = {
-            'start_time': datetime.now(),
-            'is_active': True,
-            'message_count': 0
-        }
+        logger.info(f"Ended session. {summary}")
         
-        logger.info(f"Session {'created' if is_new_session else 'renewed'}")
-        return is_new_session
-
-    async def end_session(self) -> str:
-        """End the current session"""
-        if self.current_session:
-            session_duration = datetime.now() - self.current_session['start_time']
-            messages_exchanged = self.current_session['message_count']
-            
-            if self.timeout_task:
-                self.timeout_task.cancel()
-            
-            self.current_session['is_active'] = False
-            
-            summary = (
-                "🔚 Session ended\n"
-                f"Duration: {int(session_duration.total_seconds())} seconds\n"
-                f"Messages exchanged: {messages_exchanged}"
+        if session['transcript']:
+            transcript_text = "\n".join(session['transcript'])
+            print("Transcript:", transcript_text)
+            appointment_workflow = components.get("appointment_workflow")
+            tenant = components.get("tenants").configs.get(session['tenant_id'])
+            # On the background pool: the gateway may queue this call for minutes
+            result = await run_background(
+                appointment_workflow.process_transcript_and_send_to_webhook,
+                transcript_text, webhook_url=tenant.webhook_url if tenant else None,
+                appointments=appointments_for(tenant) if tenant else None,
             )
-            
-            logger.info(f"Ended session. {summary}")
-            
-            if self.transcript:
-                transcript_text = "\n".join(self.transcript)
-                print("Transcript:", transcript_text)
-                result = appointment_workflow.process_transcript_and_send_to_webhook(transcript_text)
-                print("Result:", result)
-                transcript_text = ""
-                self.transcript = []
-                
-            
-            self.current_session = None
-            return summary
-        return "No active session to end"
+            print("Result:", result)
+        
+        return summary
         
-    def add_to_transcript(self, sender: str, message: str):
+    def add_to_transcript(self, session: dict, sender: str, message: str):
         """Add message to transcript"""
-        self.transcript.append(f"{sender}: {message}")
-
-    async def start_timeout(self, send_message_callback):
-        """Start timeout countdown for session"""
-        if self.current_session:
-            if self.timeout_task:
-                self.timeout_task.cancel()
-            
-            self.timeout_task = asyncio.create_task(
-                self._timeout_handler(send_message_callback)
-            )
+        session['transcript'].append(f"{sender}: {message}")
 
-    async def _timeout_handler(self, send_message_callback):
+    async def start_timeout(self, sender: str, send_message_callback):
+        """Start timeout countdown for the sender's session"""
+        self._cancel_timeout(sender)
+        self.timeout_tasks[sender] = asyncio.create_task(
+            self._timeout_handler(sender, send_message_callback)
+        )
+
+    async def _timeout_handler(self, sender: str, send_message_callback):
         """Handle session timeout"""
-        await asyncio.sleep(self.timeout)
-        summary = await self.end_session()
+        delay = self.timeout
+        while True:
+            await asyncio.sleep(delay)
+            session = self.backend.get(self._key(sender))
+            if session is None:
+                return
+            delay = self.timeout - (time.time() - session['last_activity'])
+            if delay <= 0:
+                break
+            # Renewed on another worker, check again when it could expire
+
+        self.timeout_tasks.pop(sender, None)
+        summary = await self.end_session(sender, idle_for=self.timeout)
+        if summary is None:
+            return
         timeout_message = (
             "⏰ Session timed out due to inactivity.\n"
             f"{summary}\n\n"
@@ -123,29 +207,66 @@ class SessionManager:
         # Send the timeout message using the callback
         await send_message_callback(timeout_message)
 
-    def increment_message_count(self):
-        """Increment the message count for current session"""
-        if self.current_session:
-            self.current_session['message_count'] += 1
+    async def compact_memory(self, sender: str, compactor: MemoryCompactor):
+        """Fold older turns of the sender's conversation into its rolling summary.
+
+        Runs as a background task after the reply has been sent. The summary
+        is computed on a snapshot; it is only written back if no message has
+        been compacted or dropped in the meantime.
+        """
+        session = self.backend.get(self._key(sender))
+        if not session:
+            return
+        memory = ConversationMemory.from_dict(session['memory'])
+        if not memory.needs_compaction():
+            return
+        to_fold = compactor.messages_to_fold(memory)
+        if not to_fold:
+            return
+
+        try:
+            summary = await run_background(compactor.summarize, memory.summary, to_fold)
+        except Exception as e:
+            logger.error(f"Error compacting conversation memory: {e}")
+            return
 
-    def get_session_info(self) -> str:
-        """Get current session information"""
-        if self.current_session:
-            duration = datetime.now() - self.current_session['start_time']
+        # Re-read, the next message may have been handled while summarizing
+        async with self.lock(sender):
+            session = self.backend.get(self._key(sender))
+            if not session:
+                return
+            current = ConversationMemory.from_dict(session['memory'])
+            if current.summary != memory.summary or current.messages[:len(to_fold)] != to_fold:
+                logger.info("Conversation changed while compacting, will retry after the next message")
+                return
+            current.summary = summary
+            current.messages = current.messages[len(to_fold):]
+            session['memory'] = current.to_dict()
+            self.save_session(sender, session)
+        logger.info(f"Compacted {len(to_fold)} messages into the conversation summary")
+
+    def increment_message_count(self, session: dict):
+        """Increment the message count for the session"""
+        session['message_count'] += 1
+
+    def get_session_info(self, sender: str) -> str:
+        """Get the sender's session information"""
+        session = self.backend.get(self._key(sender))
+        if session:
+            duration = time.time() - session['start_time']
             return (
-                f"Current session duration: {int(duration.total_seconds())} seconds\n"
-                f"Messages in this session: {self.current_session['message_count']}"
+                f"Current session duration: {int(duration)} seconds\n"
+                f"Messages in this session: {session['message_count']}"
             )
         return "No active session"
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Startup
+    # The vector store and chat chain are built lazily on the first message
+    # (or during the warm-up phase of main_app), not here
     logger.info("Starting up application...")
-    deep_lake = VectorStore()
-    app.state.db = deep_lake.load_db()
-    app.state.output = Output(app.state.db)
-    app.state.session_manager = SessionManager()
+    app.state.session_manager = SessionManager(components.get("state_backend"))
     
     yield
     
@@ -157,9 +278,9 @@ async def lifespan(app: FastAPI):
 
 app = FastAPI(lifespan=lifespan)
 
-def generate_response(output: Output, incoming_msg: str) -> str:
+def generate_response(output: "Output", incoming_msg: str, memory: ConversationMemory) -> str:
     """Generates a response to the incoming message using LangChain."""
-    response = output.chat(incoming_msg)
+    response = output.chat(incoming_msg, memory)
     logger.info(f"Generated response: {response}")
     return response
 
@@ -173,35 +294,65 @@ async def send_whatsapp_message(message: str):
     return str(twilio_response)
 
 @app.post("/whatsapp")
-async def whatsapp_webhook(request: Request):
+async def whatsapp_webhook(request: Request, background_tasks: BackgroundTasks):
     try:
         form = await request.form()
         incoming_msg = form.get("Body", "").strip()
         session_manager = request.app.state.session_manager
+
+        # The number the message was sent to decides which business answers
+        tenants = components.get("tenants")
+        try:
+            tenant_id = tenants.resolve(form.get("To", ""))
+        except UnknownTenantError as e:
+            logger.warning(str(e))
+            return Response(content="Unknown number", status_code=404)
+        sender = f"{tenant_id}:{form.get('From', '')}"
         
-        # Start or refresh session
-        is_new_session = await session_manager.create_session()
+        # One message per sender at a time, from loading the session to saving it
+        async with session_manager.lock(sender):
+            # Start or refresh session
+            session, is_new_session = await session_manager.create_session(sender, tenant_id)
         
-        # Increment message count and add to transcript
-        session_manager.increment_message_count()
-        session_manager.add_to_transcript("User", incoming_msg)
+            # Increment message count and add to transcript
+            session_manager.increment_message_count(session)
+            session_manager.add_to_transcript(session, "User", incoming_msg)
         
-        # Generate AI response
-        ai_response = generate_response(request.app.state.output, incoming_msg)
-        session_manager.add_to_transcript("Agent", ai_response)
+            # Generate AI response
+            tenant = await asyncio.to_thread(tenants.get, tenant_id)
+            output = await asyncio.to_thread(tenant.output)
+            memory = ConversationMemory.from_dict(session['memory'])
+            try:
+                # In a thread, the LLM gateway may hold the call until quota is available
+                ai_response = await asyncio.to_thread(generate_response, output, incoming_msg, memory)
+            except GatewayBusyError as e:
+                logger.warning(f"LLM gateway busy: {e}")
+                twilio_response = MessagingResponse()
+                twilio_response.message("We're receiving a lot of messages right now, please try again in a moment.")
+                return Response(content=str(twilio_response), media_type="application/xml")
+            session['memory'] = memory.to_dict()
+            session_manager.add_to_transcript(session, "Agent", ai_response)
         
-        # Prepare complete response
-        full_response = (
-            f"{'🆕 New session started!\n' if is_new_session else ''}"
-            f"{ai_response}\n\n"
-            "⏳ Session will timeout after 60 seconds of inactivity"
-        )
+            # Prepare complete response
+            new_session_banner = '🆕 New session started!\n' if is_new_session else ''
+            full_response = (
+                f"{new_session_banner}"
+                f"{ai_response}\n\n"
+                f"⏳ Session will timeout after {session_manager.timeout} seconds of inactivity"
+            )
         
-        # Store the last response
-        session_manager.last_response = full_response
+            # Store the last response and persist the session for the next worker
+            session['last_response'] = full_response
+            session_manager.save_session(sender, session)
         
-        # Start timeout countdown with callback to send message
-        await session_manager.start_timeout(send_whatsapp_message)
+            # Start timeout countdown with callback to send message
+            await session_manager.start_timeout(sender, send_whatsapp_message)
+
+        # Summarize older turns once the reply has gone out
+        if memory.needs_compaction():
+            background_tasks.add_task(
+                session_manager.compact_memory, sender, components.get("memory_compactor")
+            )
         
         # Create Twilio response
         twilio_response = MessagingResponse()
@@ -1,4 +1,3 @@
-from langchain_openai import ChatOpenAI
 from pydantic import BaseModel, Field
 from langchain_core.prompts import ChatPromptTemplate
 import os
@@ -7,6 +6,8 @@ import logging
 from dotenv import load_dotenv
 from datetime import datetime
 import json
+from llm_gateway import get_gateway, BACKGROUND
+from availability import AppointmentStore, parse_slot
 load_dotenv()
 
 # Set up logging
@@ -30,18 +31,18 @@ class AppointmentWorkflow:
     def __init__(self):
         self.transcript = ""
         logger.info("Initializing AppointmentWorkflow")
-        self.llm = ChatOpenAI(model="gpt-4o-mini", temperature=0)
-        self.day_name = datetime.today().strftime("%A")
-        self.today_date = datetime.today().date()
+        self.llm = get_gateway().chat_model("gpt-4o-mini", temperature=0)
 
     
-    def process_transcript_and_send_to_webhook(self, transcript):
+    def process_transcript_and_send_to_webhook(self, transcript, webhook_url=None, appointments: AppointmentStore = None):
         if not isinstance(transcript, str):
             raise TypeError(f"Transcript must be a string, got {type(transcript)}")
             
         logger.info("Processing new transcript")
         print("\nProcessing new appointment request...")
         self.transcript = transcript
+        # Read on every call: one workflow serves the process for days
+        today = datetime.today()
 
         system = """
         Extract customer details from the provided conversation transcript: 
@@ -68,14 +69,17 @@ class AppointmentWorkflow:
         try:
             print("\nExtracting customer details...")
             customer_details_input_prompt = customer_details_prompt.invoke({
-                "transcript": self.transcript,
-                "date": self.today_date,
-                "day": self.day_name
+                "transcript": transcript,
+                "date": today.date(),
+                "day": today.strftime("%A")
             })
 
             print("Customer details input prompt:", customer_details_input_prompt)
 
-            customer_details = structured_llm.invoke(customer_details_input_prompt) 
+            # Runs after the conversation, so live replies go first
+            customer_details = structured_llm.invoke(
+                customer_details_input_prompt, config={"metadata": {"llm_priority": BACKGROUND}}
+            )
             
             print("\nExtracted Details:")
             print(f"Name: {customer_details.customerName}")
@@ -84,6 +88,13 @@ class AppointmentWorkflow:
             print(f"Conversation Summary: {customer_details.conversationSummary}")
             print(f"Conversation Transcript: {customer_details.conversationTranscript}")
 
+            # Take the slot right away, so the next caller isn't offered it.
+            # The webhook is the system of record, a local store error must not stop it
+            try:
+                self.record_booking(customer_details, appointments, today.date())
+            except Exception as e:
+                logger.error(f"Error recording the booking locally: {e}")
+
             #appointment_decision  = self.check_appointment(self.transcript)
             #if appointment_decision == "no":
                 #return "User didnt book an appointment or provided details to schedule an appointment"
@@ -104,13 +115,15 @@ class AppointmentWorkflow:
             print("\nSending to webhook...")
             print(f"Payload: {payload}")
 
-            if not WEBHOOK_URL:
+            # Tenants can have their own Make.com scenario
+            webhook_url = webhook_url or WEBHOOK_URL
+            if not webhook_url:
                 print("\nWarning: WEBHOOK_URL environment variable not set")
                 return "Test mode: Webhook URL not configured"
             
             try:
                 response = requests.post(
-                    WEBHOOK_URL,
+                    webhook_url,
                     json=payload,
                 )
                 
@@ -139,6 +152,23 @@ class AppointmentWorkflow:
             print(f"\nError: {error_msg}")
             return None
 
+    def record_booking(self, customer_details: CustomerDetails, appointments: AppointmentStore = None, today=None):
+        if appointments is None:
+            return
+        start = parse_slot(
+            customer_details.customerAvailability_date, customer_details.customerAvailability_time,
+            today or datetime.today().date()
+        )
+        if start is None:
+            logger.info("No complete appointment date and time in the transcript, nothing booked")
+            return
+        overlapping = appointments.book(
+            customer_details.customerName, start, summary=customer_details.conversationSummary
+        )
+        if overlapping:
+            names = ", ".join(booking["name"] for booking in overlapping)
+            logger.warning(f"Appointment for {customer_details.customerName} at {start} overlaps: {names}")
+
 #for testing
 def main():
     print("\n=== Starting Appointment Processing ===\n")
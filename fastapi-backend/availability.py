@@ -0,0 +1,429 @@
+import os
+import sys
+import json
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from bisect import bisect_left, bisect_right
+from datetime import date, datetime, timedelta
+from datetime import time as dtime
+from typing import Dict, List, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Windows, only safe with a single worker
+    fcntl = None
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Length of an appointment in minutes, the Make scenario books 30 minute calendar events
+APPOINTMENT_MINUTES = int(os.getenv("APPOINTMENT_MINUTES", 30))
+# Opening hours and days, tenants can override them in tenants.json
+BUSINESS_HOURS = os.getenv("BUSINESS_HOURS", "09:00-17:00")
+BUSINESS_DAYS = os.getenv("BUSINESS_DAYS", "mon,tue,wed,thu,fri")
+# Days of free times shown to the text agent on every turn
+AVAILABILITY_SNAPSHOT_DAYS = int(os.getenv("AVAILABILITY_SNAPSHOT_DAYS", 5))
+# How far ahead alternatives are searched for when a slot is taken
+ALTERNATIVES_SEARCH_DAYS = 14
+
+WEEKDAYS = ["mon", "tue", "wed", "thu", "fri", "sat", "sun"]
+WEEKDAY_NAMES = ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"]
+# Day zero of Excel serial dates (Lotus 1-2-3 leap year bug included)
+EXCEL_EPOCH = datetime(1899, 12, 30)
+# Index keys are whole minutes since this moment
+_EPOCH = datetime(2000, 1, 1)
+
+DATE_FORMATS = ["%Y-%m-%d", "%m/%d/%Y", "%B %d, %Y", "%b %d, %Y", "%B %d %Y", "%d %B %Y", "%d %b %Y", "%A, %B %d, %Y"]
+TIME_FORMATS = ["%H:%M", "%H:%M:%S", "%I:%M %p", "%I:%M%p", "%I %p", "%I%p"]
+
+
+def _minutes(moment: datetime) -> int:
+    return (moment - _EPOCH) // timedelta(minutes=1)
+
+
+def _moment(minutes: int) -> datetime:
+    return _EPOCH + timedelta(minutes=minutes)
+
+
+def parse_date(text, today: Optional[date] = None) -> Optional[date]:
+    """'2024-11-04', 'November 4, 2024', 'today', 'tomorrow' or a weekday name (the next one, today included)"""
+    if isinstance(text, datetime):
+        return text.date()
+    if isinstance(text, date):
+        return text
+    if not text:
+        return None
+    today = today or date.today()
+    text = str(text).strip()
+    lowered = text.lower()
+    if lowered == "today":
+        return today
+    if lowered == "tomorrow":
+        return today + timedelta(days=1)
+    if lowered in WEEKDAYS or lowered in WEEKDAY_NAMES:
+        return today + timedelta(days=(WEEKDAYS.index(lowered[:3]) - today.weekday()) % 7)
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.strptime(text, fmt).date()
+        except ValueError:
+            pass
+    return None
+
+
+def parse_time(text) -> Optional[dtime]:
+    """'14:00', '2 PM', '2:30pm', 'p.m.' spelled with dots included"""
+    if isinstance(text, datetime):
+        return text.time()
+    if isinstance(text, dtime):
+        return text
+    if not text:
+        return None
+    text = str(text).strip().upper().replace(".", "")
+    for fmt in TIME_FORMATS:
+        try:
+            return datetime.strptime(text, fmt).time()
+        except ValueError:
+            pass
+    return None
+
+
+def parse_slot(date_text, time_text, today: Optional[date] = None) -> Optional[datetime]:
+    """Start of an appointment from the date and time the workflow extracted, None if either is missing"""
+    day = parse_date(date_text, today)
+    at = parse_time(time_text)
+    if day is None or at is None:
+        return None
+    return datetime.combine(day, at)
+
+
+def parse_hours(hours: str) -> Tuple[dtime, dtime]:
+    """'09:00-17:00' -> (opening time, closing time)"""
+    opening, closing = (parse_time(part) for part in hours.split("-"))
+    if opening is None or closing is None or closing <= opening:
+        raise ValueError(f"Invalid business hours {hours!r}, expected e.g. 09:00-17:00")
+    return opening, closing
+
+
+class IntervalIndex:
+    """Booked intervals sorted by start, in whole minutes.
+
+    Any interval overlapping [start, end) starts before `end` and after
+    `start - max_length`, so an overlap query is two bisects plus a scan of
+    the few intervals in between, whatever the number of bookings.
+    """
+
+    def __init__(self):
+        self.starts: List[int] = []
+        self.entries: List[Tuple[int, int, int]] = []  # (start, end, booking number)
+        self.max_length = 0
+
+    def add(self, start: int, end: int, number: int):
+        position = bisect_right(self.starts, start)
+        self.starts.insert(position, start)
+        self.entries.insert(position, (start, end, number))
+        self.max_length = max(self.max_length, end - start)
+
+    def overlapping(self, start: int, end: int) -> List[Tuple[int, int, int]]:
+        low = bisect_right(self.starts, start - self.max_length)
+        high = bisect_left(self.starts, end)
+        return [entry for entry in self.entries[low:high] if entry[1] > start]
+
+    def __len__(self):
+        return len(self.starts)
+
+
+class AppointmentStore:
+    """Booked appointments of one tenant, with an interval index for free-slot queries.
+
+    Bookings are kept in a JSON file next to the tenant's other data. Each
+    query checks whether the file was replaced first, so bookings written by
+    another worker show up on the next query. Writes hold an exclusive lock
+    on PATH.lock and reload before appending, so workers never overwrite
+    each other's bookings.
+    """
+
+    def __init__(self, path: str, slot_minutes: int = APPOINTMENT_MINUTES,
+                 hours: str = BUSINESS_HOURS, days: str = BUSINESS_DAYS):
+        self.path = path
+        self.slot_minutes = slot_minutes
+        self.opening, self.closing = parse_hours(hours)
+        self.open_days = {WEEKDAYS.index(day.strip().lower()[:3]) for day in days.split(",") if day.strip()}
+        self.bookings: List[dict] = []
+        self.index = IntervalIndex()
+        self._version = None
+        self._lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._lock:
+            self._refresh()
+
+    @contextmanager
+    def _write_lock(self):
+        """This store's thread lock plus an exclusive file lock shared with other workers"""
+        with self._lock, open(f"{self.path}.lock", "a") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                # Another worker may have written since our last read
+                self._refresh()
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _file_version(stat) -> Tuple[int, int]:
+        # os.replace() gives every write a new inode, even within one mtime tick
+        return stat.st_ino, stat.st_mtime_ns
+
+    def _refresh(self):
+        """Reload the bookings if the file changed since it was last read"""
+        try:
+            version = self._file_version(os.stat(self.path))
+        except FileNotFoundError:
+            return
+        if version == self._version:
+            return
+        with open(self.path, "r") as f:
+            bookings = json.load(f).get("bookings", [])
+        self.bookings = []
+        self.index = IntervalIndex()
+        for booking in bookings:
+            self._add(booking)
+        self._version = version
+        logger.info(f"Loaded {len(self.bookings)} appointments from {self.path}")
+
+    def _add(self, booking: dict):
+        start = _minutes(datetime.fromisoformat(booking["start"]))
+        self.index.add(start, start + booking["minutes"], len(self.bookings))
+        self.bookings.append(booking)
+
+    def _save(self):
+        """Write all bookings, only called under _write_lock()"""
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"bookings": self.bookings}, f, indent=2)
+        os.replace(tmp_path, self.path)
+        self._version = self._file_version(os.stat(self.path))
+
+    def is_open(self, day: date) -> bool:
+        return day.weekday() in self.open_days
+
+    def conflicts(self, start: datetime, minutes: Optional[int] = None) -> List[dict]:
+        """Bookings overlapping an appointment starting at `start`"""
+        begin = _minutes(start)
+        with self._lock:
+            self._refresh()
+            entries = self.index.overlapping(begin, begin + (minutes or self.slot_minutes))
+            return [self.bookings[number] for _, _, number in entries]
+
+    def is_free(self, start: datetime, minutes: Optional[int] = None) -> bool:
+        """Within opening hours and not overlapping any booking"""
+        end = start + timedelta(minutes=minutes or self.slot_minutes)
+        if not self.is_open(start.date()) or start.time() < self.opening or end > datetime.combine(start.date(), self.closing):
+            return False
+        return not self.conflicts(start, minutes)
+
+    def free_slots(self, day: date, now: Optional[datetime] = None) -> List[datetime]:
+        """Start times of the free appointment slots on a day, past ones excluded"""
+        if not self.is_open(day):
+            return []
+        now = now or datetime.now()
+        opening = _minutes(datetime.combine(day, self.opening))
+        closing = _minutes(datetime.combine(day, self.closing))
+        with self._lock:
+            self._refresh()
+            booked = self.index.overlapping(opening, closing)
+
+        # One sweep over the day's bookings, which are sorted by start
+        slots = []
+        earliest = _minutes(now)
+        position = 0
+        busy_until = opening
+        for start in range(opening, closing - self.slot_minutes + 1, self.slot_minutes):
+            end = start + self.slot_minutes
+            while position < len(booked) and booked[position][0] < end:
+                busy_until = max(busy_until, booked[position][1])
+                position += 1
+            if start >= earliest and busy_until <= start:
+                slots.append(_moment(start))
+        return slots
+
+    def free_ranges(self, day: date, now: Optional[datetime] = None) -> List[Tuple[dtime, dtime]]:
+        """Free slots of a day merged into ranges, e.g. [(09:00, 11:30), (13:00, 17:00)]"""
+        ranges = []
+        step = timedelta(minutes=self.slot_minutes)
+        for slot in self.free_slots(day, now):
+            if ranges and ranges[-1][1] == slot:
+                ranges[-1][1] = slot + step
+            else:
+                ranges.append([slot, slot + step])
+        return [(start.time(), end.time()) for start, end in ranges]
+
+    def next_free_slots(self, after: datetime, limit: int = 3) -> List[datetime]:
+        """The first free slots at or after a moment, looking ALTERNATIVES_SEARCH_DAYS ahead"""
+        slots = []
+        for offset in range(ALTERNATIVES_SEARCH_DAYS):
+            day = after.date() + timedelta(days=offset)
+            slots.extend(slot for slot in self.free_slots(day, now=after) if slot >= after)
+            if len(slots) >= limit:
+                break
+        return slots[:limit]
+
+    def book(self, name: str, start: datetime, minutes: Optional[int] = None,
+             summary: str = "", source: str = "conversation") -> List[dict]:
+        """Record an appointment and return the bookings it overlaps.
+
+        The appointment was already agreed with the customer, so it is
+        recorded even when it overlaps; the caller decides how to flag it.
+        """
+        minutes = minutes or self.slot_minutes
+        booking = {
+            "name": name,
+            "start": start.isoformat(timespec="minutes"),
+            "minutes": minutes,
+            "summary": summary,
+            "source": source,
+        }
+        with self._write_lock():
+            begin = _minutes(start)
+            overlapping = [self.bookings[number] for _, _, number in self.index.overlapping(begin, begin + minutes)]
+            self._add(booking)
+            self._save()
+        logger.info(f"Booked {name} at {booking['start']} ({len(overlapping)} overlapping)")
+        return overlapping
+
+    def snapshot(self, now: Optional[datetime] = None, days: int = AVAILABILITY_SNAPSHOT_DAYS) -> str:
+        """Today's date and the free times of the next open days, compact enough for every prompt"""
+        now = now or datetime.now()
+        lines = [f"Today is {now:%A %Y-%m-%d}. Appointments last {self.slot_minutes} minutes."]
+        day = now.date()
+        shown = 0
+        for _ in range(days * 7):
+            if shown == days:
+                break
+            if self.is_open(day):
+                ranges = self.free_ranges(day, now)
+                free = ", ".join(f"{start:%H:%M}-{end:%H:%M}" for start, end in ranges) or "fully booked"
+                lines.append(f"{day:%a %Y-%m-%d}: {free}")
+                shown += 1
+            day += timedelta(days=1)
+        return "\n".join(lines)
+
+    def import_workbook(self, path: str, sheet: str = "Transcripts") -> int:
+        """Import the bookings of the Make scenario's Database.xlsx, returns how many were added.
+
+        Rows without a usable date or time (the scenario writes "Unavailable")
+        and rows already imported are skipped.
+        """
+        try:
+            from openpyxl import load_workbook
+        except ImportError as e:
+            raise ImportError("The openpyxl package is required to import Database.xlsx") from e
+
+        rows = load_workbook(path, read_only=True, data_only=True)[sheet].iter_rows(values_only=True)
+        header = [str(cell).strip() if cell is not None else "" for cell in next(rows)]
+        columns = {name: header.index(name) for name in
+                   ("Customer Name", "Available Date", "Available Time", "Conversation Summary") if name in header}
+
+        def cell(row, name):
+            position = columns.get(name)
+            return row[position] if position is not None and position < len(row) else None
+
+        rows_read = []
+        for row in rows:
+            day = _excel_date(cell(row, "Available Date"))
+            at = _excel_time(cell(row, "Available Time"))
+            if day is None or at is None:
+                continue
+            rows_read.append({
+                "name": str(cell(row, "Customer Name") or "").strip(),
+                "start": datetime.combine(day, at).isoformat(timespec="minutes"),
+                "minutes": self.slot_minutes,
+                "summary": str(cell(row, "Conversation Summary") or ""),
+                "source": "workbook",
+            })
+
+        with self._write_lock():
+            existing = {(booking["name"], booking["start"]) for booking in self.bookings}
+            added = [booking for booking in rows_read if (booking["name"], booking["start"]) not in existing]
+            for booking in added:
+                self._add(booking)
+            if added:
+                self._save()
+        logger.info(f"Imported {len(added)} appointments from {path}")
+        return len(added)
+
+
+def _excel_date(value) -> Optional[date]:
+    # openpyxl converts date-formatted cells, serials and text are handled too
+    if isinstance(value, (int, float)):
+        return (EXCEL_EPOCH + timedelta(days=value)).date()
+    return parse_date(value)
+
+
+def _excel_time(value) -> Optional[dtime]:
+    if isinstance(value, (int, float)):
+        return (datetime.min + timedelta(minutes=round(value % 1 * 24 * 60))).time()
+    return parse_time(value)
+
+
+_stores: Dict[str, AppointmentStore] = {}
+_stores_lock = threading.Lock()
+
+
+def open_store(path: str, **kwargs) -> AppointmentStore:
+    """Shared store for a bookings file, one instance per path in this process"""
+    with _stores_lock:
+        store = _stores.get(path)
+        if store is None:
+            store = _stores[path] = AppointmentStore(path, **kwargs)
+        return store
+
+
+def import_main(workbook_path: str, store_path: str = "appointments.json"):
+    store = AppointmentStore(store_path)
+    added = store.import_workbook(workbook_path)
+    print(f"Imported {added} appointments into {store_path}")
+    print(store.snapshot())
+
+
+#for testing: free-slot query time against a year of bookings
+def main():
+    import random
+    import tempfile
+
+    path = os.path.join(tempfile.mkdtemp(), "appointments.json")
+    store = AppointmentStore(path)
+
+    # A year of a busy calendar
+    today = date.today()
+    random.seed(0)
+    bookings = []
+    for _ in range(5000):
+        day = today + timedelta(days=random.randrange(365))
+        start = datetime.combine(day, store.opening) + timedelta(minutes=30 * random.randrange(16))
+        bookings.append({"name": "Test", "start": start.isoformat(), "minutes": 30, "summary": "", "source": "test"})
+    with open(path, "w") as f:
+        json.dump({"bookings": bookings}, f)
+    store = AppointmentStore(path)
+
+    days = [today + timedelta(days=random.randrange(365)) for _ in range(10000)]
+    now = datetime.combine(today, dtime())
+    started = time.perf_counter()
+    for day in days:
+        store.free_slots(day, now)
+    elapsed = time.perf_counter() - started
+    print(f"{len(store.bookings)} bookings, free_slots: {elapsed / len(days) * 1e6:.1f} µs per query")
+    print(store.snapshot(now))
+
+
+if __name__ == "__main__":
+    # python availability.py ../make_workflow/Database.xlsx [appointments.json]
+    if len(sys.argv) > 1:
+        import_main(*sys.argv[1:3])
+    else:
+        main()
@@ -0,0 +1,31 @@
+import os
+import json
+from pydantic import BaseModel
+
+# Kept apart from storage.py, which pulls in LangChain and OpenAI: the
+# servers only need to read the details, not to produce them
+
+
+class Details(BaseModel):
+    company_name: str
+    short_description: str
+    services: str
+    summary: str
+
+class CompanyDetailsStorage:
+    def __init__(self, storage_path="company_details.json"):
+        self.storage_path = storage_path
+
+    def save_details(self, details: Details):
+        """Save company details to a JSON file"""
+        with open(self.storage_path, 'w') as f:
+            json.dump(details.model_dump(), f, indent=2)
+
+    def load_details(self) -> Details:
+        """Load company details from the JSON file"""
+        if not os.path.exists(self.storage_path):
+            raise FileNotFoundError("Company details have not been stored yet")
+        
+        with open(self.storage_path, 'r') as f:
+            data = json.load(f)
+        return Details(**data)
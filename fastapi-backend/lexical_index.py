@@ -0,0 +1,178 @@
+import os
+import re
+import json
+import math
+import logging
+from collections import Counter, defaultdict
+from typing import Dict, List, Tuple
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Share of the query's IDF weight the best lexical hit must cover to skip the vector search
+SHORT_CIRCUIT_COVERAGE = float(os.getenv("SHORT_CIRCUIT_COVERAGE", 0.8))
+# ...and must score this many times the next hit, so a generic match shared by many passages doesn't
+SHORT_CIRCUIT_MARGIN = float(os.getenv("SHORT_CIRCUIT_MARGIN", 1.5))
+
+STOP_WORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "can", "do", "does", "for", "from", "have",
+    "how", "i", "if", "in", "is", "it", "me", "my", "of", "on", "or", "our", "so", "that", "the",
+    "there", "this", "to", "we", "what", "when", "where", "which", "who", "why", "will", "with",
+    "you", "your",
+}
+
+
+# Words are truncated to this many characters, a crude but effective stemmer:
+# "cancellation" and "cancel", "insurance" and "insured" share a term
+STEM_LENGTH = 6
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercased, truncation-stemmed words without stop words"""
+    return [
+        word[:STEM_LENGTH]
+        for word in re.findall(r"[a-z0-9]+", text.lower())
+        if word not in STOP_WORDS
+    ]
+
+
+def split_passages(text: str) -> List[str]:
+    """Blank-line separated passages, so a Q: line stays with its A: line"""
+    return [passage.strip() for passage in re.split(r"\n\s*\n", text) if passage.strip()]
+
+
+class BM25Index:
+    """In-memory BM25 inverted index over knowledge base passages"""
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.passages: List[str] = []
+        self.lengths: List[int] = []
+        self.postings: Dict[str, List[Tuple[int, int]]] = defaultdict(list)
+
+    def add(self, passages: List[str]):
+        for passage in passages:
+            doc_id = len(self.passages)
+            tokens = tokenize(passage)
+            self.passages.append(passage)
+            self.lengths.append(len(tokens))
+            for term, tf in Counter(tokens).items():
+                self.postings[term].append((doc_id, tf))
+
+    def idf(self, term: str) -> float:
+        df = len(self.postings.get(term, ()))
+        n = len(self.passages)
+        return math.log(1 + (n - df + 0.5) / (df + 0.5))
+
+    def search(self, query: str, k: int = 10) -> List[Tuple[int, float, float]]:
+        """Top k passages as (doc_id, score, coverage).
+
+        coverage is the share of the query's total IDF carried by the query
+        terms that occur in the passage; 1.0 means every term matched.
+        """
+        terms = set(tokenize(query))
+        if not terms or not self.passages:
+            return []
+        avg_length = sum(self.lengths) / len(self.lengths)
+        weights = {term: self.idf(term) for term in terms}
+        total_weight = sum(weights.values())
+
+        scores: Dict[int, float] = defaultdict(float)
+        matched: Dict[int, float] = defaultdict(float)
+        for term in terms:
+            for doc_id, tf in self.postings.get(term, ()):
+                norm = tf + self.k1 * (1 - self.b + self.b * self.lengths[doc_id] / avg_length)
+                scores[doc_id] += weights[term] * tf * (self.k1 + 1) / norm
+                matched[doc_id] += weights[term]
+
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+        return [(doc_id, score, matched[doc_id] / total_weight) for doc_id, score in ranked]
+
+    def save(self, path: str):
+        with open(path, "w") as f:
+            json.dump({"k1": self.k1, "b": self.b, "passages": self.passages}, f)
+
+    @classmethod
+    def load(cls, path: str) -> "BM25Index":
+        """Load the passages saved at ingestion time and rebuild the postings"""
+        with open(path, "r") as f:
+            data = json.load(f)
+        index = cls(data["k1"], data["b"])
+        index.add(data["passages"])
+        return index
+
+
+class HybridRetriever(BaseRetriever):
+    """BM25 and vector search fused with reciprocal rank fusion.
+
+    Both stores index the same passages: every vector store chunk carries
+    the passage_id of the BM25 passage it was cut from, so results are
+    fused per passage and the whole passage is returned once.
+
+    When the best lexical hit covers nearly all of a multi-word query and
+    clearly outscores the next one (e.g. "what is your cancellation policy"
+    against a stored Q: line), the lexical passages are returned directly
+    and the embedding call and dense search are skipped.
+    """
+
+    index: BM25Index
+    vector_retriever: BaseRetriever
+    k: int = 10
+    rrf_k: int = 60
+    short_circuit_coverage: float = SHORT_CIRCUIT_COVERAGE
+    short_circuit_margin: float = SHORT_CIRCUIT_MARGIN
+
+    def _passage_document(self, doc_id: int, **metadata) -> Document:
+        return Document(page_content=self.index.passages[doc_id], metadata={"passage_id": doc_id, **metadata})
+
+    def _lexical_documents(self, hits) -> List[Document]:
+        return [self._passage_document(doc_id, source="lexical", bm25=score) for doc_id, score, _ in hits]
+
+    def _short_circuit(self, query: str, hits) -> bool:
+        """Whether the lexical hits alone answer the query"""
+        if not hits or hits[0][2] < self.short_circuit_coverage:
+            return False
+        # A single term covers the whole query whatever it matches
+        if len(set(tokenize(query))) < 2:
+            return False
+        return len(hits) == 1 or hits[0][1] >= self.short_circuit_margin * hits[1][1]
+
+    def _passage_key(self, document: Document):
+        try:
+            passage_id = int(document.metadata["passage_id"])
+        except (KeyError, TypeError, ValueError):
+            passage_id = None
+        if passage_id is not None and 0 <= passage_id < len(self.index.passages):
+            return passage_id
+        # Chunks ingested before passage ids were stored fuse on their text
+        return document.page_content
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        hits = self.index.search(query, self.k)
+        if self._short_circuit(query, hits):
+            logger.info(f"Lexical match covers {hits[0][2]:.0%} of the query, skipping vector search")
+            return self._lexical_documents(hits)
+
+        dense = self.vector_retriever.invoke(query, config={"callbacks": run_manager.get_child()})
+
+        # Reciprocal rank fusion per passage, passages found by both searches add up.
+        # Only a passage's best ranked chunk counts, however many of its chunks matched
+        fused: Dict[object, float] = defaultdict(float)
+        documents: Dict[object, Document] = {}
+        for ranked in (self._lexical_documents(hits), dense):
+            seen = set()
+            for document in ranked:
+                key = self._passage_key(document)
+                if key in seen:
+                    continue
+                fused[key] += 1.0 / (self.rrf_k + len(seen) + 1)
+                seen.add(key)
+                if key not in documents:
+                    documents[key] = self._passage_document(key) if isinstance(key, int) else document
+        order = sorted(fused, key=fused.get, reverse=True)[: self.k]
+        return [documents[key] for key in order]
@@ -0,0 +1,293 @@
+import os
+import time
+import heapq
+import asyncio
+import logging
+import functools
+import itertools
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple, TYPE_CHECKING
+from uuid import UUID
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.outputs import LLMResult
+
+if TYPE_CHECKING:
+    from langchain_openai import ChatOpenAI
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Limits assumed until the first response headers arrive
+LLM_GATEWAY_RPM = int(os.getenv("LLM_GATEWAY_RPM", 500))
+LLM_GATEWAY_TPM = int(os.getenv("LLM_GATEWAY_TPM", 200000))
+
+# Priority classes, lower is served first. Pass as run metadata:
+#   chain.invoke(inputs, config={"metadata": {"llm_priority": "background"}})
+INTERACTIVE = "interactive"
+BACKGROUND = "background"
+PRIORITIES = {INTERACTIVE: 0, BACKGROUND: 1}
+
+# Bounded queueing per class: how many calls may wait and for how long
+MAX_QUEUED = {
+    INTERACTIVE: int(os.getenv("LLM_GATEWAY_MAX_QUEUED", 100)),
+    BACKGROUND: int(os.getenv("LLM_GATEWAY_MAX_QUEUED_BACKGROUND", 50)),
+}
+MAX_WAIT = {
+    INTERACTIVE: float(os.getenv("LLM_GATEWAY_MAX_WAIT", 10)),
+    BACKGROUND: float(os.getenv("LLM_GATEWAY_MAX_WAIT_BACKGROUND", 300)),
+}
+
+# Threads for background work. Admission blocks the calling thread, so
+# background calls waiting for quota must not sit in the default executor
+# that serves live replies (asyncio.to_thread)
+LLM_BACKGROUND_WORKERS = int(os.getenv("LLM_BACKGROUND_WORKERS", 4))
+
+# Completion tokens assumed per call when reserving, corrected from usage afterwards
+COMPLETION_TOKENS_ESTIMATE = 300
+
+
+class GatewayBusyError(RuntimeError):
+    """The call could not be admitted within its queue bounds"""
+
+
+class TokenBucket:
+    """Per-minute limit refilled continuously, corrected from what the API reports"""
+
+    def __init__(self, limit_per_minute: int):
+        self.capacity = float(limit_per_minute)
+        self.level = float(limit_per_minute)
+        self.updated = time.monotonic()
+
+    @property
+    def rate(self) -> float:
+        return self.capacity / 60.0
+
+    def refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """Seconds until `amount` is available (amount is capped at capacity)"""
+        missing = min(amount, self.capacity) - self.level
+        return max(0.0, missing / self.rate) if self.rate else float("inf")
+
+    def observe(self, limit: Optional[float], remaining: Optional[float]):
+        if limit:
+            self.capacity = float(limit)
+        if remaining is not None:
+            # The server's count is authoritative, but keep our own reservations
+            self.level = min(self.level, float(remaining))
+
+
+class ModelLimiter:
+    """Request and token buckets for one model, plus its admission queue"""
+
+    def __init__(self, rpm: int, tpm: int):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.queue: List[Tuple[int, int]] = []  # heap of (priority, sequence)
+        self.queued: Dict[str, int] = {name: 0 for name in PRIORITIES}
+
+
+class LLMGateway:
+    """Process-wide admission control in front of the OpenAI account quota.
+
+    Every chat model in the app comes from chat_model(), which shares the
+    client per configuration and attaches a callback that blocks each call
+    until the model's buckets allow it. Waiting calls are served by priority
+    class, then in arrival order. Response headers correct the buckets, so
+    the gateway tracks the real account limits instead of discovering them
+    through 429s. Realtime `rate_limits.updated` events are tracked for
+    reporting only, see observe_rate_limits.
+    """
+
+    def __init__(self, rpm: int = LLM_GATEWAY_RPM, tpm: int = LLM_GATEWAY_TPM):
+        self.rpm = rpm
+        self.tpm = tpm
+        self._limiters: Dict[str, ModelLimiter] = {}
+        self._models: Dict[Tuple[str, float], "ChatOpenAI"] = {}
+        self._reservations: Dict[UUID, Tuple[str, float]] = {}
+        self._sequence = itertools.count()
+        self._cond = threading.Condition()
+        self.callback = GatewayCallbackHandler(self)
+
+    def chat_model(self, model: str = "gpt-4o-mini", temperature: float = 0) -> "ChatOpenAI":
+        """Shared chat model whose calls go through the gateway"""
+        # langchain_openai takes about a second to import, only pay for it once a model is needed
+        from langchain_openai import ChatOpenAI
+        key = (model, temperature)
+        with self._cond:
+            if key not in self._models:
+                self._models[key] = ChatOpenAI(
+                    model=model,
+                    temperature=temperature,
+                    include_response_headers=True,
+                    callbacks=[self.callback],
+                )
+            return self._models[key]
+
+    def _limiter(self, model: str) -> ModelLimiter:
+        if model not in self._limiters:
+            self._limiters[model] = ModelLimiter(self.rpm, self.tpm)
+        return self._limiters[model]
+
+    def acquire(self, model: str, tokens: float, priority: str = INTERACTIVE):
+        """Block until one request and `tokens` tokens of the model's quota are admitted"""
+        priority = priority if priority in PRIORITIES else INTERACTIVE
+        with self._cond:
+            limiter = self._limiter(model)
+            if limiter.queued[priority] >= MAX_QUEUED[priority]:
+                raise GatewayBusyError(f"Too many {priority} calls queued for {model}")
+
+            entry = (PRIORITIES[priority], next(self._sequence))
+            heapq.heappush(limiter.queue, entry)
+            limiter.queued[priority] += 1
+            deadline = time.monotonic() + MAX_WAIT[priority]
+            try:
+                while True:
+                    now = time.monotonic()
+                    limiter.requests.refill(now)
+                    limiter.tokens.refill(now)
+                    wait = max(limiter.requests.wait_time(1), limiter.tokens.wait_time(tokens))
+                    if limiter.queue[0] == entry and wait == 0:
+                        limiter.requests.level -= 1
+                        limiter.tokens.level -= min(tokens, limiter.tokens.capacity)
+                        return
+                    if now + wait > deadline or now >= deadline:
+                        raise GatewayBusyError(f"{priority} call to {model} would wait more than {MAX_WAIT[priority]}s")
+                    # Woken early whenever the queue or the buckets change
+                    self._cond.wait(timeout=max(wait, 0.01) if limiter.queue[0] == entry else deadline - now)
+            finally:
+                limiter.queue.remove(entry)
+                heapq.heapify(limiter.queue)
+                limiter.queued[priority] -= 1
+                self._cond.notify_all()
+
+    def settle(self, model: str, reserved: float, used: float):
+        """Correct a reservation with the tokens the call actually used"""
+        with self._cond:
+            self._limiter(model).tokens.level += reserved - used
+            self._cond.notify_all()
+
+    def throttle(self, model: str):
+        """A 429 got through anyway: hold new calls until the buckets refill"""
+        with self._cond:
+            limiter = self._limiter(model)
+            limiter.requests.level = min(limiter.requests.level, 0.0)
+            limiter.tokens.level = min(limiter.tokens.level, 0.0)
+
+    def observe_headers(self, model: str, headers: Dict[str, str]):
+        """Update a model's buckets from x-ratelimit-* response headers"""
+        def number(name):
+            value = headers.get(name)
+            try:
+                return float(value) if value is not None else None
+            except ValueError:
+                return None
+
+        with self._cond:
+            limiter = self._limiter(model)
+            limiter.requests.observe(number("x-ratelimit-limit-requests"), number("x-ratelimit-remaining-requests"))
+            limiter.tokens.observe(number("x-ratelimit-limit-tokens"), number("x-ratelimit-remaining-tokens"))
+            self._cond.notify_all()
+
+    def observe_rate_limits(self, model: str, rate_limits: List[dict]):
+        """Update a model's buckets from a realtime `rate_limits.updated` event.
+
+        Reporting only: the realtime model has its own quota and nothing
+        acquires from it (a live call is never held for admission), so these
+        buckets only show the realtime headroom on /llm-gateway.
+        """
+        with self._cond:
+            limiter = self._limiter(model)
+            for item in rate_limits:
+                bucket = {"requests": limiter.requests, "tokens": limiter.tokens}.get(item.get("name"))
+                if bucket is not None:
+                    bucket.observe(item.get("limit"), item.get("remaining"))
+            self._cond.notify_all()
+
+    def stats(self) -> Dict[str, dict]:
+        with self._cond:
+            return {
+                model: {
+                    "requests_available": round(limiter.requests.level, 1),
+                    "tokens_available": round(limiter.tokens.level),
+                    "queued": dict(limiter.queued),
+                }
+                for model, limiter in self._limiters.items()
+            }
+
+
+class GatewayCallbackHandler(BaseCallbackHandler):
+    """Admits, settles and observes every call made by the gateway's chat models"""
+
+    # Let GatewayBusyError abort the call instead of being logged and ignored
+    raise_error = True
+
+    def __init__(self, gateway: LLMGateway):
+        self.gateway = gateway
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, metadata=None, **kwargs):
+        metadata = metadata or {}
+        model = metadata.get("ls_model_name") or "default"
+        prompt_tokens = sum(len(str(message.content)) for batch in messages for message in batch) / 4
+        reserved = prompt_tokens + COMPLETION_TOKENS_ESTIMATE
+        self.gateway.acquire(model, reserved, metadata.get("llm_priority", INTERACTIVE))
+        with self.gateway._cond:
+            self.gateway._reservations[run_id] = (model, reserved)
+
+    def on_llm_end(self, response: LLMResult, *, run_id, **kwargs):
+        with self.gateway._cond:
+            model, reserved = self.gateway._reservations.pop(run_id, (None, 0.0))
+        if model is None:
+            return
+        usage = (response.llm_output or {}).get("token_usage") or {}
+        self.gateway.settle(model, reserved, usage.get("total_tokens", reserved))
+        for generations in response.generations:
+            for generation in generations:
+                headers = (generation.generation_info or {}).get("headers")
+                if headers:
+                    self.gateway.observe_headers(model, headers)
+                    return
+
+    def on_llm_error(self, error: BaseException, *, run_id, **kwargs):
+        with self.gateway._cond:
+            model, reserved = self.gateway._reservations.pop(run_id, (None, 0.0))
+        if model is None:
+            return
+        # A failed call (timeout, 5xx, connection error) used no tokens
+        self.gateway.settle(model, reserved, 0)
+        if type(error).__name__ == "RateLimitError":
+            logger.warning(f"Rate limited on {model}, holding new calls")
+            self.gateway.throttle(model)
+
+
+_gateway: Optional[LLMGateway] = None
+_gateway_lock = threading.Lock()
+
+
+def get_gateway() -> LLMGateway:
+    """The process-wide gateway"""
+    global _gateway
+    with _gateway_lock:
+        if _gateway is None:
+            _gateway = LLMGateway()
+        return _gateway
+
+
+_background_executor = ThreadPoolExecutor(max_workers=LLM_BACKGROUND_WORKERS, thread_name_prefix="llm-background")
+
+
+async def run_background(func, *args, **kwargs):
+    """Like asyncio.to_thread, but on the bounded background pool.
+
+    Use it for work that makes BACKGROUND priority calls (memory compaction,
+    transcript extraction): however long they wait for quota, they hold at
+    most LLM_BACKGROUND_WORKERS threads and never delay interactive work.
+    """
+    loop = asyncio.get_running_loop()
+    call = functools.partial(contextvars.copy_context().run, func, *args, **kwargs)
+    return await loop.run_in_executor(_background_executor, call)
@@ -1,11 +1,17 @@
 # main.py
+import os
+import asyncio
 import uvicorn
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 import logging
 from contextlib import asynccontextmanager
-from app_call import myapp as call_app
-from app_text import app as text_app, lifespan as text_lifespan
+from startup import profiler, components, STARTUP_WARMUP, warmup_targets
+
+with profiler.measure("import app_call"):
+    from app_call import myapp as call_app, lifespan as call_lifespan
+with profiler.measure("import app_text"):
+    from app_text import app as text_app, lifespan as text_lifespan
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -13,8 +19,14 @@ logger = logging.getLogger(__name__)
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    # Initialize text app dependencies
-    async with text_lifespan(text_app):
+    # Mounted apps don't run their own lifespans, so nest them here:
+    # text app dependencies, and the call app's realtime connection pool
+    async with text_lifespan(text_app), call_lifespan(call_app):
+        # Optional warm-up phase, otherwise components are built on first use
+        if STARTUP_WARMUP:
+            with profiler.measure("warm-up"):
+                await asyncio.to_thread(components.warm_up, warmup_targets())
+        logger.info(profiler.report())
         yield
 
 # Create the main application
@@ -33,6 +45,17 @@ main_app.add_middleware(
 main_app.mount("/call", call_app)
 main_app.mount("/text", text_app)
 
+@main_app.get("/startup-report")
+async def startup_report():
+    return {
+        "timings_ms": {name: round(seconds * 1000, 1) for name, seconds in profiler.timings.items()}
+    }
+
+@main_app.get("/llm-gateway")
+async def llm_gateway_stats():
+    from llm_gateway import get_gateway
+    return get_gateway().stats()
+
 # Root endpoint
 @main_app.get("/")
 async def root():
@@ -45,5 +68,8 @@ async def root():
     }
 
 if __name__ == "__main__":
-    # Run the server on port 8000
-    uvicorn.run(main_app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    # Run the server on port 8000. More than one worker needs a shared
+    # STATE_BACKEND_URL (sqlite:// or redis://) so conversations survive
+    # landing on a different worker
+    workers = int(os.getenv("WEB_CONCURRENCY", 1))
+    uvicorn.run("main_app:main_app", host="0.0.0.0", port=8000, workers=workers)
\ No newline at end of file
@@ -0,0 +1,139 @@
+import os
+import logging
+from typing import List, Optional
+from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.messages import (
+    AIMessage,
+    BaseMessage,
+    HumanMessage,
+    SystemMessage,
+    messages_from_dict,
+    messages_to_dict,
+)
+from llm_gateway import get_gateway, BACKGROUND
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Upper bound on the tokens the conversation (summary + recent messages) adds to a prompt
+MEMORY_TOKEN_BUDGET = int(os.getenv("MEMORY_TOKEN_BUDGET", 1200))
+# Share of the budget the summary may take
+SUMMARY_TOKEN_BUDGET = MEMORY_TOKEN_BUDGET // 3
+# Compaction starts once summary + messages exceed the high watermark, early
+# enough to finish before prompt_messages() has to drop anything. It then
+# folds old messages until those left verbatim fit under the low watermark,
+# so the next few turns only append to the prompt and the compacted prefix
+# stays byte-identical (and cached) until the high watermark is hit again
+MEMORY_HIGH_WATERMARK = int(os.getenv("MEMORY_HIGH_WATERMARK", MEMORY_TOKEN_BUDGET * 3 // 4))
+MEMORY_LOW_WATERMARK = int(os.getenv("MEMORY_LOW_WATERMARK", MEMORY_TOKEN_BUDGET // 4))
+
+_encoding = None
+
+
+def count_tokens(text: str) -> int:
+    """Token count with tiktoken, or a 4-characters-per-token estimate if it is unavailable"""
+    global _encoding
+    if _encoding is None:
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding("o200k_base")
+        except Exception:
+            _encoding = False
+    if _encoding:
+        return len(_encoding.encode(text))
+    return len(text) // 4 + 1
+
+
+class ConversationMemory:
+    """Rolling summary of older turns plus the most recent messages verbatim.
+
+    Serialized into the session record with to_dict()/from_dict(). Answering
+    only reads it through prompt_messages(), which never exceeds the token
+    budget; folding old turns into the summary happens later in
+    MemoryCompactor, off the request path.
+    """
+
+    def __init__(self, summary: str = "", messages: Optional[List[BaseMessage]] = None):
+        self.summary = summary
+        self.messages: List[BaseMessage] = messages or []
+
+    @classmethod
+    def from_dict(cls, data: Optional[dict]) -> "ConversationMemory":
+        if not data:
+            return cls()
+        return cls(data.get("summary", ""), messages_from_dict(data.get("messages", [])))
+
+    def to_dict(self) -> dict:
+        return {"summary": self.summary, "messages": messages_to_dict(self.messages)}
+
+    def add_exchange(self, question: str, answer: str):
+        self.messages.extend([HumanMessage(question), AIMessage(answer)])
+
+    def add_ai_message(self, message: str):
+        self.messages.append(AIMessage(message))
+
+    def message_tokens(self) -> int:
+        return sum(count_tokens(message.content) for message in self.messages)
+
+    def needs_compaction(self) -> bool:
+        return count_tokens(self.summary) + self.message_tokens() > MEMORY_HIGH_WATERMARK
+
+    def prompt_messages(self, budget: int = MEMORY_TOKEN_BUDGET) -> List[BaseMessage]:
+        """Summary plus as many of the most recent messages as fit in the budget"""
+        selected = []
+        summary = self.summary
+        if summary and count_tokens(summary) > SUMMARY_TOKEN_BUDGET:
+            # The summarizer is asked to stay short, this only guards against it not doing so
+            summary = summary[: SUMMARY_TOKEN_BUDGET * 4]
+        remaining = budget - (count_tokens(summary) if summary else 0)
+
+        # Messages not yet compacted are dropped oldest first if they don't fit
+        for message in reversed(self.messages):
+            tokens = count_tokens(message.content)
+            if tokens > remaining:
+                break
+            selected.append(message)
+            remaining -= tokens
+        selected.reverse()
+
+        if summary:
+            selected.insert(0, SystemMessage(f"Summary of the earlier conversation: {summary}"))
+        return selected
+
+
+class MemoryCompactor:
+    """Folds the older messages of a ConversationMemory into its summary"""
+
+    def __init__(self):
+        self.llm = get_gateway().chat_model("gpt-4o-mini", temperature=0)
+        self.prompt = ChatPromptTemplate.from_messages([
+            ("system",
+             "You maintain a running summary of a conversation between a customer and Donna, "
+             "an AI receptionist. Merge the new messages into the existing summary. Keep names, "
+             "dates, times, services and any appointment details exactly. Write at most "
+             f"{SUMMARY_TOKEN_BUDGET * 3 // 4} words and return only the summary."),
+            ("user", "Existing summary:\n{summary}\n\nNew messages:\n{messages}"),
+        ])
+        self.chain = self.prompt | self.llm
+
+    def messages_to_fold(self, memory: ConversationMemory) -> List[BaseMessage]:
+        """Oldest messages to fold so that the rest fits under the low watermark"""
+        fold = 0
+        remaining = memory.message_tokens()
+        # Keep at least the last exchange verbatim even if it is over the watermark
+        while fold < len(memory.messages) - 2 and remaining > MEMORY_LOW_WATERMARK:
+            remaining -= count_tokens(memory.messages[fold].content)
+            fold += 1
+        return memory.messages[:fold]
+
+    def summarize(self, summary: str, messages: List[BaseMessage]) -> str:
+        transcript = "\n".join(
+            f"{'User' if isinstance(message, HumanMessage) else 'Agent'}: {message.content}"
+            for message in messages
+        )
+        result = self.chain.invoke(
+            {"summary": summary or "(none)", "messages": transcript},
+            config={"metadata": {"llm_priority": BACKGROUND}},
+        )
+        return result.content.strip()
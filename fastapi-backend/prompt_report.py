@@ -0,0 +1,156 @@
+"""Input tokens per turn for the previous and the current prompt layouts.
+
+Renders the text-channel answer prompt for a sample conversation both ways
+and counts tokens with tiktoken, or in 4-character pieces when its encoding
+can't be loaded (tiktoken downloads it on first use). "cacheable" is the token prefix shared with
+the previous turn, rounded down the way OpenAI prompt caching does it
+(nothing below 1024 tokens, then 128-token steps).
+
+    python prompt_report.py
+"""
+from company_details import CompanyDetailsStorage
+from prompts import TEXT_SYSTEM_MESSAGE, COMPANY_PROFILE, TEXT_USER_TURN, company_profile_values
+
+# Layout used before prompts.py: variables inside the system message, context
+# in the middle of it and the company fields repeated in every user turn
+LEGACY_SYSTEM_MESSAGE = '''
+            You are a Donna and  AI receptionist for the company: {company} which provides services {services}/
+            Here is the short description of the company: {short_description}.
+            Your job is to help users understand and interact with our company’s services and products. Your primary role is to answer questions based on the information extracted from our knowledge base, which includes policies, product details, and customer support procedures.
+            \n
+            On the contrary, if user wants to schedule a meeting, just ask for user's name, availability date, availability time and any any reason/requirement/description for the appointment. Make sure to ask one question at a time. Once they have provided all details kindly reply that their meeting has been scheduled. If they miss out providing any of the details, follow up with the missing details.
+            \n
+            For the context of the conversation, you can use this {context}.
+
+            If no question is asked, offer a brief overview of our company’s services and suggest possible questions related to our offerings, support, and general inquiries. If you don't know the answer, ask the user to be more specific. If the question is not related to our services, request a relevant question.
+
+            When asked for specific policies or procedures, provide exact information as it appears in our knowledge base; do not generate or summarize details on your own.
+
+            Your goals are to:
+
+            - Answer questions related to our company’s services and products.
+            - Provide relevant details, policies, and procedures as needed.
+            - Offer guidance on navigating our services and accessing support.
+            - Assist with common inquiries about service offerings, account management, and procedures.
+            - Keep the answers concise and informative, avoiding unnecessary details or jargon.
+
+            Behavior Guidelines:
+
+            - Be helpful, friendly, and concise.
+            - Provide accurate information and explanations when requested.
+            - Focus solely on the information available in the knowledge base context.
+            - If a question is anything not relevant simply ask questions relevant to the company.
+            - Use simple language to ensure clarity, avoiding technical jargon unless necessary.
+            - Keep the answers as concise as posible.
+            \n
+            Again, if user wants to schedule a meeting, just ask for user's name, availability date and time and any reason/requirement/description for the appointment. And kindly reply that their meeting has been scheduled. If they have not provided any of the details, follow up and ask for the relevant missing details with regards to appointment.
+
+        '''
+LEGACY_USER_TURN = "User : {input}, company: {company}, services: {services}, short_description: {short_description}"
+LEGACY_ANSWER_TURN = "Given the above conversation, generate an answer to the user's question."
+
+SAMPLE_QUESTIONS = [
+    "Hi, what do you offer?",
+    "Do you offer virtual therapy sessions?",
+    "What is your cancellation policy?",
+    "Do you accept insurance?",
+    "I'd like to book a stress management session",
+    "My name is Alex, next Monday at 3pm works",
+]
+
+# What AppointmentStore.snapshot() produces for a partly booked week
+SAMPLE_AVAILABILITY = """Today is Monday 2026-10-19. Appointments last 30 minutes.
+Mon 2026-10-19: 13:00-17:00
+Tue 2026-10-20: 09:00-10:00, 11:30-17:00
+Wed 2026-10-21: 09:00-17:00
+Thu 2026-10-22: 09:00-12:00, 14:00-17:00
+Fri 2026-10-23: 09:00-16:30"""
+
+# Chat format overhead per message (role and separators), as counted by OpenAI
+TOKENS_PER_MESSAGE = 4
+
+
+def sample_context(turn: int) -> str:
+    """Stand-in for the retrieved documents of a turn: a few Q&A pairs from the example knowledge base"""
+    with open("example_knowledge_base.txt", "r") as file:
+        pairs = [pair for pair in file.read().split("\n\n") if pair.strip()]
+    start = (turn * 3) % len(pairs)
+    return "\n\n".join(pairs[start:start + 4])
+
+
+def legacy_messages(values: dict, history: list, question: str, context: str) -> list:
+    return (
+        [("system", LEGACY_SYSTEM_MESSAGE.format(context=context, **values))]
+        + history
+        + [("user", LEGACY_USER_TURN.format(input=question, **values)), ("user", LEGACY_ANSWER_TURN)]
+    )
+
+
+def current_messages(values: dict, history: list, question: str, context: str) -> list:
+    return (
+        [("system", TEXT_SYSTEM_MESSAGE), ("system", COMPANY_PROFILE.format(**values))]
+        + history
+        + [("user", TEXT_USER_TURN.format(availability=SAMPLE_AVAILABILITY, context=context, input=question))]
+    )
+
+
+class CharEstimate:
+    """Stand-in encoding, 4 characters per token like memory.count_tokens"""
+
+    def encode(self, text: str) -> list:
+        return [text[i:i + 4] for i in range(0, len(text), 4)]
+
+
+def load_encoding():
+    try:
+        import tiktoken
+        return tiktoken.get_encoding("o200k_base")
+    except Exception as e:
+        print(f"tiktoken encoding unavailable ({type(e).__name__}), estimating 4 characters per token")
+        return CharEstimate()
+
+
+def encode(encoding, messages: list) -> list:
+    tokens = []
+    for role, content in messages:
+        tokens.extend(encoding.encode(f"<|{role}|>"))
+        tokens.extend(encoding.encode(content))
+        tokens.extend([0] * (TOKENS_PER_MESSAGE - 1))
+    return tokens
+
+
+def shared_prefix(a: list, b: list) -> int:
+    n = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        n += 1
+    return n
+
+
+def cacheable(prefix: int) -> int:
+    return 0 if prefix < 1024 else 1024 + (prefix - 1024) // 128 * 128
+
+
+def main():
+    encoding = load_encoding()
+    values = company_profile_values(CompanyDetailsStorage().load_details())
+
+    for name, build in (("previous layout", legacy_messages), ("current layout", current_messages)):
+        print(f"\n{name}")
+        print(f"{'turn':>4}  {'input':>6}  {'static prefix':>13}  {'cacheable':>9}")
+        history, previous, total_input, total_cached = [], [], 0, 0
+        for turn, question in enumerate(SAMPLE_QUESTIONS):
+            tokens = encode(encoding, build(values, history, question, sample_context(turn)))
+            prefix = shared_prefix(previous, tokens) if previous else 0
+            cached = cacheable(prefix)
+            total_input += len(tokens)
+            total_cached += cached
+            print(f"{turn + 1:>4}  {len(tokens):>6}  {prefix:>13}  {cached:>9}")
+            history = (history + [("user", question), ("assistant", "Sure, happy to help with that.")])[-6:]
+            previous = tokens
+        print(f"total input tokens: {total_input}, cacheable: {total_cached}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+import os
+import time
+import asyncio
+import logging
+from collections import deque
+from typing import Awaitable, Callable, Deque, Optional, Set, Tuple
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Ready connections kept open at all times, 0 disables the pool
+REALTIME_POOL_SIZE = int(os.getenv("REALTIME_POOL_SIZE", 2))
+# Hard cap including connections opened for announced calls
+REALTIME_POOL_MAX = int(os.getenv("REALTIME_POOL_MAX", REALTIME_POOL_SIZE + 8))
+# Unused connections are closed after this long (the API also ends idle sessions)
+REALTIME_POOL_IDLE_SECONDS = float(os.getenv("REALTIME_POOL_IDLE_SECONDS", 300))
+# An announced call that never connects stops counting after this long
+ANNOUNCED_CALL_SECONDS = 30
+
+
+class RealtimePool:
+    """Pool of pre-connected, pre-configured realtime API sessions.
+
+    `connect` opens a websocket and sends the tenant-independent session
+    configuration. /incoming-call announces a call with request_warm() while
+    Twilio plays the greeting, so a connection is usually ready by the time
+    media_stream claim()s one. A background task tops the pool back up and
+    closes connections that sat idle for too long.
+    """
+
+    def __init__(self, connect: Callable[[], Awaitable[object]], size: int = REALTIME_POOL_SIZE,
+                 max_size: int = REALTIME_POOL_MAX, idle_seconds: float = REALTIME_POOL_IDLE_SECONDS):
+        self.connect = connect
+        self.size = size
+        self.max_size = max(max_size, size)
+        self.idle_seconds = idle_seconds
+        self._idle: Deque[Tuple[float, object]] = deque()
+        self._announced: Deque[float] = deque()
+        self._connecting = 0
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._openers: Set[asyncio.Task] = set()
+        self.hits = 0
+        self.misses = 0
+
+    async def start(self):
+        if self.size > 0 and self._task is None:
+            self._task = asyncio.create_task(self._replenish_loop())
+            logger.info(f"Realtime pool started with {self.size} connections")
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for task in list(self._openers):
+            task.cancel()
+        while self._idle:
+            _, ws = self._idle.popleft()
+            await ws.close()
+
+    def request_warm(self):
+        """A call is on its way: make sure a connection will be waiting for it"""
+        if self._task is None:
+            return
+        self._announced.append(time.monotonic())
+        self._wakeup.set()
+
+    async def claim(self):
+        """A ready connection, or a freshly opened one if the pool is empty"""
+        if self._announced:
+            self._announced.popleft()
+        now = time.monotonic()
+        while self._idle:
+            created, ws = self._idle.pop()
+            if not ws.closed and now - created < self.idle_seconds:
+                self.hits += 1
+                self._wakeup.set()
+                return ws
+            await ws.close()
+
+        self.misses += 1
+        self._wakeup.set()
+        return await self.connect()
+
+    def stats(self) -> dict:
+        return {
+            "idle": len(self._idle),
+            "connecting": self._connecting,
+            "announced": len(self._announced),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+    def _target(self, now: float) -> int:
+        while self._announced and now - self._announced[0] > ANNOUNCED_CALL_SECONDS:
+            self._announced.popleft()
+        return min(self.max_size, self.size + len(self._announced))
+
+    async def _open_one(self):
+        self._connecting += 1
+        try:
+            ws = await self.connect()
+            self._idle.append((time.monotonic(), ws))
+        except Exception as e:
+            logger.error(f"Error pre-connecting realtime session: {e}")
+            # Don't hammer the API while it is failing
+            await asyncio.sleep(5)
+        finally:
+            self._connecting -= 1
+
+    async def _replenish_loop(self):
+        while True:
+            now = time.monotonic()
+            # Oldest connections sit at the left end
+            while self._idle and (self._idle[0][1].closed or now - self._idle[0][0] >= self.idle_seconds):
+                _, ws = self._idle.popleft()
+                await ws.close()
+
+            missing = self._target(now) - len(self._idle) - self._connecting
+            for _ in range(max(0, missing)):
+                task = asyncio.create_task(self._open_one())
+                self._openers.add(task)
+                task.add_done_callback(self._openers.discard)
+
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=min(self.idle_seconds, ANNOUNCED_CALL_SECONDS))
+            except asyncio.TimeoutError:
+                pass
@@ -0,0 +1,143 @@
+import os
+import asyncio
+import logging
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Tuple
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+DROP_OLDEST = "drop_oldest"
+DISCONNECT = "disconnect"
+OVERFLOW_POLICIES = (DROP_OLDEST, DISCONNECT)
+
+
+def _overflow_policy(name: str) -> str:
+    """Overflow policy from the environment, checked once at import rather than on every call"""
+    policy = os.getenv(name, DROP_OLDEST)
+    if policy not in OVERFLOW_POLICIES:
+        raise ValueError(f"{name}={policy!r} is not a relay overflow policy, expected one of {OVERFLOW_POLICIES}")
+    return policy
+
+
+# Messages waiting for the realtime API: caller audio in 20 ms frames, 250 is 5 s
+RELAY_INBOUND_QUEUE_SIZE = int(os.getenv("RELAY_INBOUND_QUEUE_SIZE", 250))
+# Messages waiting for Twilio: agent audio deltas, which arrive faster than real time
+RELAY_OUTBOUND_QUEUE_SIZE = int(os.getenv("RELAY_OUTBOUND_QUEUE_SIZE", 500))
+# What a full queue does: drop_oldest audio or disconnect the call
+RELAY_INBOUND_OVERFLOW = _overflow_policy("RELAY_INBOUND_OVERFLOW")
+RELAY_OUTBOUND_OVERFLOW = _overflow_policy("RELAY_OUTBOUND_OVERFLOW")
+
+
+class RelayOverflowError(Exception):
+    """A relay queue is full and nothing in it may be dropped"""
+
+
+class RelayQueue:
+    """Bounded FIFO between the task reading one socket and the task writing the other.
+
+    The reader never waits on the slow peer: put() returns at once. When the
+    queue is full, the drop_oldest policy discards the oldest audio message
+    (other messages are never dropped) and the disconnect policy raises
+    RelayOverflowError, which ends the call.
+    """
+
+    def __init__(self, name: str, maxsize: int, overflow: str = DROP_OLDEST):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown relay overflow policy {overflow!r}, expected one of {OVERFLOW_POLICIES}")
+        self.name = name
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self._items: Deque[Tuple[bool, Any]] = deque()  # (is audio, message)
+        self._condition = asyncio.Condition()
+        self.max_depth = 0
+        self.enqueued = 0
+        self.sent = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    async def put(self, message, audio: bool = False):
+        async with self._condition:
+            if len(self._items) >= self.maxsize:
+                self._make_room()
+            self._items.append((audio, message))
+            self.enqueued += 1
+            self.max_depth = max(self.max_depth, len(self._items))
+            self._condition.notify()
+
+    def _make_room(self):
+        if self.overflow == DROP_OLDEST:
+            # Usually the very first message, control messages rarely pile up
+            for position, (audio, _) in enumerate(self._items):
+                if audio:
+                    del self._items[position]
+                    self.dropped += 1
+                    return
+        raise RelayOverflowError(f"{self.name} queue is full ({self.maxsize} messages)")
+
+    async def get(self):
+        async with self._condition:
+            await self._condition.wait_for(lambda: self._items)
+            _, message = self._items.popleft()
+            return message
+
+    def stats(self) -> dict:
+        return {
+            "depth": len(self._items),
+            "max_depth": self.max_depth,
+            "enqueued": self.enqueued,
+            "sent": self.sent,
+            "dropped": self.dropped,
+        }
+
+
+async def pump(queue: RelayQueue, send: Callable[[Any], Awaitable[None]]):
+    """Writer task: send queued messages in order until cancelled"""
+    while True:
+        message = await queue.get()
+        await send(message)
+        queue.sent += 1
+
+
+class CallRelay:
+    """Both relay queues of one call"""
+
+    def __init__(self):
+        self.to_openai = RelayQueue("to_openai", RELAY_INBOUND_QUEUE_SIZE, RELAY_INBOUND_OVERFLOW)
+        self.to_twilio = RelayQueue("to_twilio", RELAY_OUTBOUND_QUEUE_SIZE, RELAY_OUTBOUND_OVERFLOW)
+
+    def stats(self) -> dict:
+        return {"to_openai": self.to_openai.stats(), "to_twilio": self.to_twilio.stats()}
+
+
+#for testing: a peer that stalls for a second while frames keep arriving
+async def main():
+    queue = RelayQueue("test", maxsize=25, overflow=DROP_OLDEST)
+    received = []
+
+    async def slow_send(message):
+        if message == 10:
+            await asyncio.sleep(1)
+        received.append(message)
+
+    writer = asyncio.create_task(pump(queue, slow_send))
+    for n in range(100):
+        await queue.put(n, audio=True)
+        await asyncio.sleep(0.02)
+    await asyncio.sleep(0.1)
+    writer.cancel()
+    print(f"received {len(received)} of 100, stats: {queue.stats()}")
+
+    strict = RelayQueue("strict", maxsize=2, overflow=DISCONNECT)
+    try:
+        for n in range(3):
+            await strict.put(n, audio=True)
+    except RelayOverflowError as e:
+        print(f"disconnect policy: {e}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,248 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+from typing import Dict, Optional, Tuple
+from urllib.parse import urlparse
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# memory://, sqlite:///path/to/state.db or redis://host:port/db
+STATE_BACKEND_URL = os.getenv("STATE_BACKEND_URL", "memory://")
+
+
+class StateBackend:
+    """Key/value store for conversation state shared between workers.
+
+    Values are JSON-serializable dicts. Every key carries a time-to-live and
+    expiry is sticky: reading a key with `ttl` set pushes its expiry forward,
+    so a conversation stays alive for as long as it keeps being used.
+    """
+
+    def get(self, key: str, ttl: Optional[float] = None) -> Optional[dict]:
+        """Return the value for key, refreshing its expiry when ttl is given"""
+        raise NotImplementedError
+
+    def set(self, key: str, value: dict, ttl: float):
+        """Store value under key for ttl seconds"""
+        raise NotImplementedError
+
+    def take(self, key: str) -> Optional[dict]:
+        """Atomically remove and return the value, so only one worker gets it"""
+        raise NotImplementedError
+
+    def add(self, key: str, value: dict, ttl: float) -> bool:
+        """Store value under key only if the key is absent, True if it was stored"""
+        raise NotImplementedError
+
+    def delete_if(self, key: str, value: dict) -> bool:
+        """Delete key only if it still holds value, True if it was deleted"""
+        raise NotImplementedError
+
+    def delete(self, key: str):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class InMemoryStateBackend(StateBackend):
+    """Process-local backend, only suitable for a single worker"""
+
+    def __init__(self):
+        self._data: Dict[str, Tuple[float, str]] = {}
+        self._lock = threading.Lock()
+
+    def _live(self, key: str) -> Optional[Tuple[float, str]]:
+        item = self._data.get(key)
+        if item is None:
+            return None
+        if item[0] <= time.time():
+            del self._data[key]
+            return None
+        return item
+
+    def get(self, key, ttl=None):
+        with self._lock:
+            item = self._live(key)
+            if item is None:
+                return None
+            if ttl is not None:
+                self._data[key] = (time.time() + ttl, item[1])
+            return json.loads(item[1])
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._data[key] = (time.time() + ttl, json.dumps(value))
+
+    def take(self, key):
+        with self._lock:
+            item = self._live(key)
+            if item is None:
+                return None
+            del self._data[key]
+            return json.loads(item[1])
+
+    def add(self, key, value, ttl):
+        with self._lock:
+            if self._live(key) is not None:
+                return False
+            self._data[key] = (time.time() + ttl, json.dumps(value))
+            return True
+
+    def delete_if(self, key, value):
+        with self._lock:
+            item = self._live(key)
+            if item is None or item[1] != json.dumps(value):
+                return False
+            del self._data[key]
+            return True
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+
+class SQLiteStateBackend(StateBackend):
+    """Backend on a SQLite file in WAL mode, shared by all workers on one host"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn = sqlite3.connect(path, timeout=5.0, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+        self._lock = threading.Lock()
+        self._writes = 0
+        self.purge_expired()
+
+    def get(self, key, ttl=None):
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM state WHERE key = ? AND expires_at > ?", (key, now)
+            ).fetchone()
+            if row is None:
+                return None
+            if ttl is not None:
+                self._conn.execute("UPDATE state SET expires_at = ? WHERE key = ?", (now + ttl, key))
+        return json.loads(row[0])
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO state (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, json.dumps(value), time.time() + ttl),
+            )
+            self._writes += 1
+            purge = self._writes % 500 == 0
+        if purge:
+            self.purge_expired()
+
+    def take(self, key):
+        with self._lock:
+            # BEGIN IMMEDIATE takes the write lock up front so two workers can't both read the row
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    "SELECT value FROM state WHERE key = ? AND expires_at > ?", (key, time.time())
+                ).fetchone()
+                self._conn.execute("DELETE FROM state WHERE key = ?", (key,))
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return json.loads(row[0]) if row else None
+
+    def add(self, key, value, ttl):
+        now = time.time()
+        with self._lock:
+            # One statement, so it is atomic: an expired row counts as absent
+            cursor = self._conn.execute(
+                "INSERT INTO state (key, value, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at "
+                "WHERE state.expires_at <= ?",
+                (key, json.dumps(value), now + ttl, now),
+            )
+        return cursor.rowcount > 0
+
+    def delete_if(self, key, value):
+        with self._lock:
+            cursor = self._conn.execute(
+                "DELETE FROM state WHERE key = ? AND value = ?", (key, json.dumps(value))
+            )
+        return cursor.rowcount > 0
+
+    def delete(self, key):
+        with self._lock:
+            self._conn.execute("DELETE FROM state WHERE key = ?", (key,))
+
+    def purge_expired(self):
+        """Remove expired rows, SQLite has no native key expiry"""
+        with self._lock:
+            self._conn.execute("DELETE FROM state WHERE expires_at <= ?", (time.time(),))
+
+    def close(self):
+        self._conn.close()
+
+
+class RedisStateBackend(StateBackend):
+    """Backend on any Redis-protocol server (Redis >= 6.2, Valkey, a local test server)"""
+
+    def __init__(self, url: str):
+        try:
+            import redis
+        except ImportError as e:
+            raise ImportError("The redis package is required for a redis:// state backend") from e
+        self._client = redis.Redis.from_url(url)
+        self._delete_if = self._client.register_script(
+            "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end return 0"
+        )
+
+    def get(self, key, ttl=None):
+        if ttl is not None:
+            raw = self._client.getex(key, ex=max(1, int(ttl)))
+        else:
+            raw = self._client.get(key)
+        return json.loads(raw) if raw is not None else None
+
+    def set(self, key, value, ttl):
+        self._client.set(key, json.dumps(value), ex=max(1, int(ttl)))
+
+    def take(self, key):
+        raw = self._client.getdel(key)
+        return json.loads(raw) if raw is not None else None
+
+    def add(self, key, value, ttl):
+        return bool(self._client.set(key, json.dumps(value), ex=max(1, int(ttl)), nx=True))
+
+    def delete_if(self, key, value):
+        return bool(self._delete_if(keys=[key], args=[json.dumps(value)]))
+
+    def delete(self, key):
+        self._client.delete(key)
+
+    def close(self):
+        self._client.close()
+
+
+def create_state_backend(url: str = STATE_BACKEND_URL) -> StateBackend:
+    """Create a state backend from a URL"""
+    scheme = urlparse(url).scheme
+    if scheme in ("", "memory"):
+        return InMemoryStateBackend()
+    if scheme == "sqlite":
+        # sqlite:///relative.db and sqlite:////absolute/path.db
+        path = url[len("sqlite:///"):]
+        logger.info(f"Using SQLite state backend at {path}")
+        return SQLiteStateBackend(path)
+    if scheme in ("redis", "rediss", "unix"):
+        logger.info("Using Redis state backend")
+        return RedisStateBackend(url)
+    raise ValueError(f"Unsupported state backend: {url}")
@@ -0,0 +1,121 @@
+import os
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, Optional
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Comma separated component names to build before serving traffic, or "all"
+STARTUP_WARMUP = os.getenv("STARTUP_WARMUP", "")
+
+
+class StartupProfiler:
+    """Collects import and initialization timings for the startup report"""
+
+    def __init__(self):
+        self.timings: Dict[str, float] = {}
+
+    @contextmanager
+    def measure(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = time.perf_counter() - start
+
+    def report(self) -> str:
+        if not self.timings:
+            return "Startup report: nothing measured yet"
+        width = max(len(name) for name in self.timings)
+        lines = ["Startup report:"]
+        for name, seconds in self.timings.items():
+            lines.append(f"  {name.ljust(width)}  {seconds * 1000:9.1f} ms")
+        return "\n".join(lines)
+
+
+class LazyComponents:
+    """Registry of heavy shared objects that are built on first use"""
+
+    def __init__(self, profiler: StartupProfiler):
+        self.profiler = profiler
+        self._factories: Dict[str, Callable[[], object]] = {}
+        self._instances: Dict[str, object] = {}
+        # Re-entrant because factories may depend on other components
+        self._lock = threading.RLock()
+
+    def register(self, name: str, factory: Callable[[], object]):
+        """Register a zero-argument factory for a component"""
+        self._factories[name] = factory
+
+    def get(self, name: str):
+        """Return the shared instance, building it on first access"""
+        instance = self._instances.get(name)
+        if instance is not None:
+            return instance
+
+        with self._lock:
+            if name not in self._instances:
+                if name not in self._factories:
+                    raise KeyError(f"Unknown component: {name}")
+                logger.info(f"Initializing component: {name}")
+                with self.profiler.measure(f"init {name}"):
+                    self._instances[name] = self._factories[name]()
+            return self._instances[name]
+
+    def is_loaded(self, name: str) -> bool:
+        return name in self._instances
+
+    def warm_up(self, names: Optional[Iterable[str]] = None):
+        """Eagerly build the given components (all registered ones by default)"""
+        for name in (names if names is not None else list(self._factories)):
+            try:
+                instance = self.get(name)
+                # Components with internal caches (e.g. tenants) warm those too
+                if hasattr(instance, "warm_up"):
+                    with self.profiler.measure(f"warm-up {name}"):
+                        instance.warm_up()
+            except Exception as e:
+                logger.error(f"Error warming up component {name}: {e}")
+
+
+def warmup_targets() -> Optional[list]:
+    """Parse STARTUP_WARMUP into component names; None means warm everything"""
+    value = STARTUP_WARMUP.strip()
+    if value.lower() == "all":
+        return None
+    return [name.strip() for name in value.split(",") if name.strip()]
+
+
+profiler = StartupProfiler()
+components = LazyComponents(profiler)
+
+
+# Factories import their modules lazily so that importing this registry stays cheap
+def _appointment_workflow():
+    from appointment_call import AppointmentWorkflow
+    return AppointmentWorkflow()
+
+
+def _state_backend():
+    from session_store import create_state_backend
+    return create_state_backend()
+
+
+def _memory_compactor():
+    from memory import MemoryCompactor
+    return MemoryCompactor()
+
+
+def _tenants():
+    from tenants import TenantRegistry
+    return TenantRegistry.from_file()
+
+
+components.register("appointment_workflow", _appointment_workflow)
+components.register("state_backend", _state_backend)
+components.register("memory_compactor", _memory_compactor)
+components.register("tenants", _tenants)
@@ -1,13 +1,13 @@
-from langchain.vectorstores import DeepLake
 from langchain_openai import OpenAIEmbeddings
 from langchain.docstore.document import Document
 import os
+import argparse
 from dotenv import load_dotenv
-from langchain.text_splitter import SpacyTextSplitter
-from langchain_openai import ChatOpenAI
 from langchain.prompts import PromptTemplate
-from pydantic import BaseModel
+from company_details import CompanyDetailsStorage, Details
 import json
+from llm_gateway import get_gateway, BACKGROUND
+from lexical_index import BM25Index, split_passages
 
 
 load_dotenv()
@@ -15,75 +15,137 @@ load_dotenv()
 activeloop_token  = os.getenv("ACTIVELOOP_TOKEN")
 openai_api_key = os.getenv("OPENAI_API_KEY")
 
-class Details(BaseModel):
-    company_name: str
-    short_description: str
-    services: str
-    summary: str
-
-class CompanyDetailsStorage:
-    def __init__(self, storage_path="company_details.json"):
-        self.storage_path = storage_path
-
-    def save_details(self, details: Details):
-        """Save company details to a JSON file"""
-        with open(self.storage_path, 'w') as f:
-            json.dump(details.model_dump(), f, indent=2)
-
-    def load_details(self) -> Details:
-        """Load company details from the JSON file"""
-        if not os.path.exists(self.storage_path):
-            raise FileNotFoundError("Company details have not been stored yet")
-        
-        with open(self.storage_path, 'r') as f:
-            data = json.load(f)
-        return Details(**data)
+# Knowledge base ingestion: characters per extraction chunk, chunks extracted
+# in parallel, and partial details merged per reduce call
+EXTRACTION_CHUNK_CHARS = int(os.getenv("EXTRACTION_CHUNK_CHARS", 12000))
+EXTRACTION_CONCURRENCY = int(os.getenv("EXTRACTION_CONCURRENCY", 4))
+REDUCE_FAN_IN = 8
+KNOWLEDGE_BASE_EXTENSIONS = (".txt", ".md")
+
+
+def chunk_text(lines, chunk_chars=EXTRACTION_CHUNK_CHARS):
+    """Group lines into chunks of about chunk_chars, preferring to cut at blank lines"""
+    buffer, size = [], 0
+    for line in lines:
+        buffer.append(line)
+        size += len(line)
+        # Cut at a passage boundary once full, or anywhere once far over
+        if (size >= chunk_chars and not line.strip()) or size >= chunk_chars * 2:
+            yield "".join(buffer)
+            buffer, size = [], 0
+    if "".join(buffer).strip():
+        yield "".join(buffer)
+
+
+def iter_chunks(source, chunk_chars=EXTRACTION_CHUNK_CHARS):
+    """Stream chunks from a file or from every knowledge base document in a directory"""
+    if os.path.isdir(source):
+        paths = sorted(
+            os.path.join(root, name)
+            for root, _, names in os.walk(source)
+            for name in names
+            if name.endswith(KNOWLEDGE_BASE_EXTENSIONS)
+        )
+    else:
+        paths = [source]
+    for path in paths:
+        with open(path, "r") as file:
+            # The file object is read line by line, never as a whole
+            yield from chunk_text(file, chunk_chars)
 
 class VectorStore:
-    def __init__(self):
+    def __init__(self, dataset_path=None, details_path="company_details.json", index_path="lexical_index.json"):
         self.embedding = OpenAIEmbeddings(model="text-embedding-3-large")
         self.activeloop_org = "<YOUR_ACTIVELOOP_ORG>"
         self.activeloop_dataset = "<YOUR_ACTIVELOOP_DATASET>"
-        self.dataset_path = f"hub://{self.activeloop_org}/{self.activeloop_dataset}"
+        # Each tenant can point at its own dataset, see tenants.py
+        self.dataset_path = dataset_path or f"hub://{self.activeloop_org}/{self.activeloop_dataset}"
         self.docs = [] 
-        self.storage = CompanyDetailsStorage()
-
-    def text_to_docs(self, text):
-        text_splitter = SpacyTextSplitter(chunk_size=100, chunk_overlap=10)
-        splitted_text = text_splitter.split_text(text)
-        docs = [Document(page_content=chunk) for chunk in splitted_text]
+        self.storage = CompanyDetailsStorage(details_path)
+        self.index_path = index_path
+        self._text_splitter = None
+
+    @property
+    def text_splitter(self):
+        # Built on first use and then reused: the constructor loads the spaCy
+        # pipeline, which would otherwise happen again for every chunk
+        if self._text_splitter is None:
+            from langchain.text_splitter import SpacyTextSplitter
+            self._text_splitter = SpacyTextSplitter(chunk_size=100, chunk_overlap=10)
+        return self._text_splitter
+
+    def text_to_docs(self, text, metadata=None):
+        splitted_text = self.text_splitter.split_text(text)
+        docs = [Document(page_content=chunk, metadata=dict(metadata or {})) for chunk in splitted_text]
         return docs
 
-    def main(self):
-        with open('example_knowledge_base.txt', 'r') as file:
-            text = file.read()  
-            print(text) 
+    def main(self, source="example_knowledge_base.txt"):
+        """Ingest a knowledge base file, or every document in a directory.
+
+        The text is streamed in chunks of EXTRACTION_CHUNK_CHARS. Each window
+        of EXTRACTION_CONCURRENCY chunks is extracted in parallel (map),
+        embedded and indexed, then dropped, so memory and time per chunk
+        stay flat however large the knowledge base is. The partial details
+        are merged into one summary at the end (reduce).
+        """
+        self.load_db()
+        index = BM25Index()
+        partials = []
+
+        window = []
+        for chunk in iter_chunks(source):
+            window.append(chunk)
+            if len(window) == EXTRACTION_CONCURRENCY:
+                partials.extend(self.ingest_window(window, index))
+                window = []
+        if window:
+            partials.extend(self.ingest_window(window, index))
 
-            self.get_company_details(text)
+        if not partials:
+            raise ValueError(f"No text found in {source}")
 
-            self.docs = self.text_to_docs(text)
+        company_details = self.reduce_details(partials)
+        self.save_company_details(company_details)
 
-            self.load_db()
+        # BM25 index beside the vector store, for hybrid retrieval
+        index.save(self.index_path)
+        print(f"Saved lexical index with {len(index.passages)} passages to {self.index_path}")
 
-            self.db.add_documents(self.docs)
+        return self.db
 
-            return self.db
+    def ingest_window(self, chunks, index):
+        """Extract partial details from the chunks concurrently, then embed and index them"""
+        partials = self.extract_details(chunks)
+        for chunk in chunks:
+            # The vector store gets the BM25 passages cut into smaller pieces,
+            # each tagged with its passage, so hybrid retrieval fuses per passage
+            docs = []
+            for passage in split_passages(chunk):
+                passage_id = len(index.passages)
+                index.add([passage])
+                docs.extend(self.text_to_docs(passage, {"passage_id": passage_id}))
+            self.db.add_documents(docs)
+        print(f"Ingested {len(chunks)} chunks")
+        return partials
     
     def load_db(self):
+        # DeepLake pulls in a large dependency tree, import it on first use
+        from langchain.vectorstores import DeepLake
         self.db = DeepLake(dataset_path = self.dataset_path, embedding=self.embedding)
         print("Loaded Vector Store!")
         return self.db
     
-    def get_company_details(self, text):
+    def extract_details(self, chunks):
+        """Map step: partial company details for each chunk, up to EXTRACTION_CONCURRENCY at a time"""
         template = """  
             You are an AI assitant who is an expert in analyzing text data. You will be provided with a text which contain Q&A pairs 
-            which typicall represent a conversation between a user and a a customer service agent. Your task is to extract: 
+            which typicall represent a conversation between a user and a a customer service agent. The text may be only one part of a larger knowledge base. Your task is to extract: 
             - company name
             - short description of 2 sentences what company does
             - services offered
             - summarize the text and extract relevant, information regarding the company name, services offered and any other relevant information. Make the summary as detailed as and descriptive with as much information as possible.
 
-            This information will be used to create a chatbot which can answer questions based on the information provided in the text and help users schedule appointments later.
+            Only use information present in this part. If something is not mentioned, leave that field empty.
 
             The text is as follows:
             {text}
@@ -94,14 +156,59 @@ class VectorStore:
             template=template,
             input_variables = ["text"],
             )
-        
-        formatted_prompt = prompt.invoke({"text": text})
 
-        llm = ChatOpenAI(model="gpt-4o-mini", temperature=0)
+        llm = get_gateway().chat_model("gpt-4o-mini", temperature=0)
+        structured_llm = llm.with_structured_output(Details)
+
+        formatted_prompts = [prompt.invoke({"text": chunk}) for chunk in chunks]
+        return structured_llm.batch(
+            formatted_prompts,
+            config={"max_concurrency": EXTRACTION_CONCURRENCY, "metadata": {"llm_priority": BACKGROUND}},
+        )
+
+    def reduce_details(self, partials):
+        """Reduce step: merge partial details, REDUCE_FAN_IN at a time, until one is left"""
+        template = """
+            You are given company details extracted separately from different parts of one company's knowledge base.
+            Merge them into a single set of details:
+            - company name
+            - short description of 2 sentences what company does
+            - services offered, without duplicates
+            - one detailed summary combining all the relevant information from the partial summaries. Keep policies and procedures exact.
+
+            This information will be used to create a chatbot which can answer questions based on the knowledge base and help users schedule appointments later.
+
+            The partial details are:
+            {partials}
+        """
+        prompt = PromptTemplate(
+            template=template,
+            input_variables = ["partials"],
+            )
+
+        llm = get_gateway().chat_model("gpt-4o-mini", temperature=0)
         structured_llm = llm.with_structured_output(Details)
 
-        company_details = structured_llm.invoke(formatted_prompt)
+        while len(partials) > 1:
+            groups = [partials[i:i + REDUCE_FAN_IN] for i in range(0, len(partials), REDUCE_FAN_IN)]
+            formatted_prompts = [
+                prompt.invoke({"partials": "\n\n".join(json.dumps(p.model_dump()) for p in group)})
+                for group in groups
+            ]
+            partials = structured_llm.batch(
+                formatted_prompts,
+                config={"max_concurrency": EXTRACTION_CONCURRENCY, "metadata": {"llm_priority": BACKGROUND}},
+            )
+        return partials[0]
+
+    def get_company_details(self, text):
+        """Extract and save company details from a text held in memory"""
+        chunks = list(chunk_text(text.splitlines(keepends=True)))
+        company_details = self.reduce_details(self.extract_details(chunks))
+        self.save_company_details(company_details)
+        return company_details
 
+    def save_company_details(self, company_details):
         self.storage.save_details(company_details)
 
         print(f"DETAILS: {company_details}\n\n-----\n\n")
@@ -115,5 +222,16 @@ class VectorStore:
 
 
 if __name__ == "__main__":
-    vector_store = VectorStore()  
-    vector_store.main()
+    # python storage.py [file or directory of documents] [--dataset-path hub://...] [--details-path ...] [--index-path ...]
+    parser = argparse.ArgumentParser(description="Ingest a knowledge base for one tenant")
+    parser.add_argument("source", nargs="?", default="example_knowledge_base.txt")
+    parser.add_argument("--dataset-path", default=None, help="DeepLake dataset, the one set in VectorStore if omitted")
+    parser.add_argument("--details-path", default="company_details.json")
+    parser.add_argument("--index-path", default="lexical_index.json")
+    args = parser.parse_args()
+
+    for path in (args.details_path, args.index_path):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+    vector_store = VectorStore(dataset_path=args.dataset_path, details_path=args.details_path, index_path=args.index_path)  
+    vector_store.main(args.source)
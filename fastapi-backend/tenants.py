@@ -0,0 +1,241 @@
+import os
+import sys
+import json
+import logging
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional
+from pydantic import BaseModel, model_validator
+from company_details import CompanyDetailsStorage, Details
+from prompts import build_voice_instructions
+from lexical_index import BM25Index
+from availability import AppointmentStore, BUSINESS_DAYS, BUSINESS_HOURS, open_store
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# JSON list of tenants, see TenantConfig. Without it the process serves a
+# single tenant built from company_details.json and the default dataset
+TENANTS_CONFIG = os.getenv("TENANTS_CONFIG", "tenants.json")
+# Most tenants kept loaded at once
+TENANT_CACHE_SIZE = int(os.getenv("TENANT_CACHE_SIZE", 100))
+# Memory cap for loaded tenants in MB (estimated from each tenant's data), 0 disables it
+TENANT_CACHE_MAX_MB = int(os.getenv("TENANT_CACHE_MAX_MB", 0))
+
+DEFAULT_TENANT_ID = "default"
+# Data files of a tenant default to TENANTS_DIR/<tenant_id>/, the default
+# tenant keeps them in the working directory where storage.py writes them
+TENANTS_DIR = os.getenv("TENANTS_DIR", "tenants")
+
+
+class UnknownTenantError(KeyError):
+    """No tenant is configured for the number a message or call was sent to"""
+
+
+class TenantConfig(BaseModel):
+    tenant_id: str
+    # Twilio numbers of the business, as they appear in the `To` parameter
+    phone_numbers: List[str] = []
+    company_details_path: Optional[str] = None
+    # DeepLake dataset, None uses the one configured in VectorStore
+    dataset_path: Optional[str] = None
+    # BM25 index written by storage.py, hybrid retrieval is off if it is missing
+    lexical_index_path: Optional[str] = None
+    # Make.com webhook for appointments, None uses WEBHOOK_URL
+    webhook_url: Optional[str] = None
+    # Booked appointments, checked by the agents before confirming a time
+    appointments_path: Optional[str] = None
+    business_hours: str = BUSINESS_HOURS
+    business_days: str = BUSINESS_DAYS
+
+    @model_validator(mode="after")
+    def _tenant_paths(self):
+        """Unset paths point into the tenant's own directory, never at another tenant's files"""
+        if self.company_details_path is None:
+            self.company_details_path = tenant_path(self.tenant_id, "company_details.json")
+        if self.lexical_index_path is None:
+            self.lexical_index_path = tenant_path(self.tenant_id, "lexical_index.json")
+        if self.appointments_path is None:
+            self.appointments_path = tenant_path(self.tenant_id, "appointments.json")
+        return self
+
+
+def tenant_path(tenant_id: str, filename: str) -> str:
+    if tenant_id == DEFAULT_TENANT_ID:
+        return filename
+    return os.path.join(TENANTS_DIR, tenant_id, filename)
+
+
+def check_isolation(configs: List[TenantConfig]):
+    """Refuse configs where two tenants would read each other's data"""
+    for field in ("company_details_path", "lexical_index_path", "appointments_path", "dataset_path"):
+        owners: Dict[Optional[str], str] = {}
+        for config in configs:
+            path = getattr(config, field)
+            # No dataset_path means the dataset set in storage.py, which only one tenant may use
+            key = os.path.normpath(path) if path else None
+            if key in owners:
+                raise ValueError(
+                    f"Tenants {owners[key]} and {config.tenant_id} share {field} {path or '(default)'}"
+                )
+            owners[key] = config.tenant_id
+
+
+def normalize_number(number: str) -> str:
+    """'whatsapp:+1 415 523 8886' -> '+14155238886'"""
+    number = number.strip()
+    if number.startswith("whatsapp:"):
+        number = number[len("whatsapp:"):]
+    return "".join(ch for ch in number if ch.isdigit() or ch == "+")
+
+
+def _deep_size(strings) -> int:
+    """Bytes held by a collection of Python strings"""
+    return sum(sys.getsizeof(string) for string in strings)
+
+
+def _dir_size(path: str) -> int:
+    """Bytes of the files under a local directory"""
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def appointments_for(config: TenantConfig) -> AppointmentStore:
+    """The tenant's appointment store, shared by every context and outliving cache eviction"""
+    return open_store(config.appointments_path, hours=config.business_hours, days=config.business_days)
+
+
+class TenantContext:
+    """Everything one tenant needs to answer, built on first use"""
+
+    def __init__(self, config: TenantConfig):
+        self.config = config
+        self.details: Details = CompanyDetailsStorage(config.company_details_path).load_details()
+        self.voice_instructions = build_voice_instructions(self.details)
+        self.lexical_index: Optional[BM25Index] = None
+        if os.path.exists(config.lexical_index_path):
+            self.lexical_index = BM25Index.load(config.lexical_index_path)
+        self.appointments = appointments_for(config)
+        self.size_mb = 0.0
+        self._output = None
+        self._lock = threading.Lock()
+
+    def output(self):
+        """Retrieval chain for the text channel, opens the tenant's vector store on first call"""
+        if self._output is None:
+            with self._lock:
+                if self._output is None:
+                    from storage import VectorStore
+                    from ai_output import Output
+                    db = VectorStore(dataset_path=self.config.dataset_path).load_db()
+                    self._output = Output(db, self.details, self.lexical_index, self.appointments)
+        return self._output
+
+    def estimate_size_mb(self) -> float:
+        """Memory the tenant's own data takes, independent of what else loads meanwhile.
+
+        Counts the details, the voice instructions, the BM25 passages and
+        postings, and a local DeepLake dataset at its size on disk. A remote
+        (hub://) dataset is streamed through DeepLake's cache and not counted.
+        """
+        size = sys.getsizeof(self.details.model_dump_json()) + sys.getsizeof(self.voice_instructions)
+        if self.lexical_index is not None:
+            index = self.lexical_index
+            size += _deep_size(index.passages) + sys.getsizeof(index.lengths)
+            size += sys.getsizeof(index.postings) + _deep_size(index.postings)
+            # Each posting is a list slot pointing to a (doc_id, tf) tuple
+            posting_size = 8 + sys.getsizeof((0, 0))
+            size += sum(sys.getsizeof(postings) + len(postings) * posting_size
+                        for postings in index.postings.values())
+        dataset_path = self.config.dataset_path
+        if dataset_path and os.path.isdir(dataset_path):
+            size += _dir_size(dataset_path)
+        return size / (1024 * 1024)
+
+
+class TenantRegistry:
+    """Resolves Twilio numbers to tenants and keeps their contexts in an LRU cache"""
+
+    def __init__(self, configs: List[TenantConfig], cache_size: int = TENANT_CACHE_SIZE,
+                 max_mb: int = TENANT_CACHE_MAX_MB):
+        check_isolation(configs)
+        self.configs: Dict[str, TenantConfig] = {config.tenant_id: config for config in configs}
+        self.by_number: Dict[str, str] = {
+            normalize_number(number): config.tenant_id
+            for config in configs
+            for number in config.phone_numbers
+        }
+        self.cache_size = cache_size
+        self.max_mb = max_mb
+        self._cache: "OrderedDict[str, TenantContext]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._loading: Dict[str, threading.Lock] = {}
+
+    @classmethod
+    def from_file(cls, path: str = TENANTS_CONFIG) -> "TenantRegistry":
+        if not os.path.exists(path):
+            logger.info("No tenants config found, serving a single tenant")
+            return cls([TenantConfig(tenant_id=DEFAULT_TENANT_ID)])
+        with open(path, "r") as f:
+            configs = [TenantConfig(**item) for item in json.load(f)]
+        logger.info(f"Loaded {len(configs)} tenants from {path}")
+        return cls(configs)
+
+    def resolve(self, to_number: str) -> str:
+        """Tenant id for the number a call or message was sent to"""
+        tenant_id = self.by_number.get(normalize_number(to_number or ""))
+        if tenant_id:
+            return tenant_id
+        # A single-tenant deployment answers on any number
+        if len(self.configs) == 1:
+            return next(iter(self.configs))
+        raise UnknownTenantError(f"No tenant configured for {to_number}")
+
+    def get(self, tenant_id: str) -> TenantContext:
+        """Loaded context for the tenant, building it on a cache miss"""
+        with self._lock:
+            context = self._cache.get(tenant_id)
+            if context is not None:
+                self._cache.move_to_end(tenant_id)
+                return context
+            if tenant_id not in self.configs:
+                raise UnknownTenantError(f"Unknown tenant {tenant_id}")
+            loading = self._loading.setdefault(tenant_id, threading.Lock())
+
+        # Build outside the registry lock so one slow tenant doesn't block the others
+        with loading:
+            with self._lock:
+                context = self._cache.get(tenant_id)
+                if context is not None:
+                    return context
+            # The vector store opens on the text path (output()), not here: a
+            # call only needs the details, instructions, BM25 and appointments
+            context = TenantContext(self.configs[tenant_id])
+            context.size_mb = context.estimate_size_mb()
+            logger.info(f"Loaded tenant {tenant_id} (~{context.size_mb:.1f} MB)")
+
+            with self._lock:
+                self._cache[tenant_id] = context
+                self._loading.pop(tenant_id, None)
+                self._evict()
+        return context
+
+    def _evict(self):
+        """Drop least recently used tenants over the count or memory cap, newest always stays"""
+        while len(self._cache) > 1 and (
+            len(self._cache) > self.cache_size
+            or (self.max_mb and sum(c.size_mb for c in self._cache.values()) > self.max_mb)
+        ):
+            tenant_id, _ = self._cache.popitem(last=False)
+            logger.info(f"Evicted tenant {tenant_id} from cache")
+
+    def warm_up(self):
+        """Load the first configured tenant, vector store included, ahead of traffic"""
+        self.get(next(iter(self.configs))).output()
@@ -0,0 +1,162 @@
+import os
+import base64
+import logging
+from collections import deque
+from typing import Deque, List
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Drop silent inbound frames before they reach the realtime API, off by default
+VOICE_GATE = os.getenv("VOICE_GATE", "0").lower() in ("1", "true", "yes", "on")
+# RMS level (16-bit PCM scale) a frame needs to count as voice, 300 is about -40 dBFS
+VOICE_GATE_THRESHOLD = float(os.getenv("VOICE_GATE_THRESHOLD", 300))
+# Silence still sent after voice. Server VAD ends a turn after 500 ms of
+# silence (silence_duration_ms) and must hear it, so this has to be longer
+VOICE_GATE_HANGOVER_MS = int(os.getenv("VOICE_GATE_HANGOVER_MS", 800))
+# Silent frames held back and sent just before voice resumes, so word onsets
+# quieter than the threshold are not clipped
+VOICE_GATE_PREROLL_MS = int(os.getenv("VOICE_GATE_PREROLL_MS", 100))
+
+# Twilio sends 8 kHz μ-law in 20 ms frames
+FRAME_MS = 20
+
+
+def _ulaw_to_linear(byte: int) -> int:
+    """G.711 μ-law byte to a 16-bit PCM sample"""
+    byte = ~byte & 0xFF
+    magnitude = ((((byte & 0x0F) << 3) + 0x84) << ((byte >> 4) & 0x07)) - 0x84
+    return -magnitude if byte & 0x80 else magnitude
+
+
+ULAW_TO_LINEAR = [_ulaw_to_linear(byte) for byte in range(256)]
+# The gate only needs frame energy, so μ-law bytes map straight to squared
+# samples: one table lookup per sample replaces decoding, then squaring
+ULAW_SQUARED = [sample * sample for sample in ULAW_TO_LINEAR]
+if np is not None:
+    ULAW_SQUARED_TABLE = np.array(ULAW_SQUARED, dtype=np.float64)
+
+
+def frame_rms(raw: bytes, use_numpy: bool = True) -> float:
+    """RMS level of a μ-law frame, on the 16-bit PCM scale"""
+    if not raw:
+        return 0.0
+    if use_numpy and np is not None:
+        # take() and sum() skip the fancy indexing and mean() overhead, which
+        # dominate at 160 samples per frame
+        return float(ULAW_SQUARED_TABLE.take(np.frombuffer(raw, dtype=np.uint8)).sum() / len(raw)) ** 0.5
+    return (sum(map(ULAW_SQUARED.__getitem__, raw)) / len(raw)) ** 0.5
+
+
+class VoiceGate:
+    """Energy voice activity gate with hangover for one call's inbound audio.
+
+    Frames above the threshold open the gate; it stays open for the hangover
+    so the server VAD still hears the pause that ends a turn. While closed,
+    the last few frames are kept as pre-roll and sent ahead of the next voice
+    frame. Everything else is dropped and counted.
+    """
+
+    def __init__(self, threshold: float = VOICE_GATE_THRESHOLD, hangover_ms: int = VOICE_GATE_HANGOVER_MS,
+                 preroll_ms: int = VOICE_GATE_PREROLL_MS, use_numpy: bool = True):
+        self.threshold = threshold
+        self.hangover_frames = hangover_ms // FRAME_MS
+        self.use_numpy = use_numpy
+        self._preroll: Deque[str] = deque(maxlen=max(0, preroll_ms // FRAME_MS))
+        self._open_for = 0
+        self.frames_in = 0
+        self.frames_sent = 0
+        self.frames_dropped = 0
+        self.bytes_dropped = 0
+
+    def process(self, payload: str) -> List[str]:
+        """Base64 payloads to append for this inbound frame: none, the frame, or pre-roll plus the frame"""
+        self.frames_in += 1
+        if frame_rms(base64.b64decode(payload), self.use_numpy) >= self.threshold:
+            self._open_for = self.hangover_frames
+            payloads = list(self._preroll)
+            self._preroll.clear()
+            payloads.append(payload)
+        elif self._open_for > 0:
+            self._open_for -= 1
+            payloads = [payload]
+        else:
+            payloads = []
+            # A full pre-roll pushes out its oldest frame, or this one if it holds none
+            if len(self._preroll) == self._preroll.maxlen:
+                self._drop(self._preroll[0] if self._preroll else payload)
+            self._preroll.append(payload)
+        self.frames_sent += len(payloads)
+        return payloads
+
+    def _drop(self, payload: str):
+        self.frames_dropped += 1
+        self.bytes_dropped += len(payload)
+
+    def stats(self) -> dict:
+        return {
+            "frames_in": self.frames_in,
+            "frames_sent": self.frames_sent,
+            "frames_dropped": self.frames_dropped,
+            "dropped_share": round(self.frames_dropped / self.frames_in, 3) if self.frames_in else 0.0,
+            "bytes_dropped": self.bytes_dropped,
+        }
+
+
+#for testing: CPU cost per frame and upstream traffic saved on a synthetic call
+def main():
+    import json
+    import math
+    import random
+    import time
+
+    def linear_to_ulaw(sample: int) -> int:
+        sign = 0x80 if sample < 0 else 0
+        magnitude = min(abs(sample), 32635) + 0x84
+        exponent = max(0, min(7, magnitude.bit_length() - 8))
+        mantissa = (magnitude >> (exponent + 3)) & 0x0F
+        return ~(sign | (exponent << 4) | mantissa) & 0xFF
+
+    # One minute alternating 3 s of speech-like tone and 3 s of line noise
+    random.seed(0)
+    frames = []
+    for n in range(60 * 1000 // FRAME_MS):
+        speaking = (n * FRAME_MS // 3000) % 2 == 0
+        raw = bytes(
+            linear_to_ulaw(int(
+                (3000 * math.sin(2 * math.pi * 220 * (n * 160 + i) / 8000) if speaking else 0)
+                + random.gauss(0, 30)
+            ))
+            for i in range(160)
+        )
+        frames.append(base64.b64encode(raw).decode("utf-8"))
+
+    message_bytes = len(json.dumps({"type": "input_audio_buffer.append", "audio": frames[0]}))
+    for use_numpy in ([True, False] if np is not None else [False]):
+        gate = VoiceGate(use_numpy=use_numpy)
+        started = time.perf_counter()
+        for _ in range(10):
+            for payload in frames:
+                gate.process(payload)
+        per_frame = (time.perf_counter() - started) / (10 * len(frames))
+        stats = gate.stats()
+        print(f"{'numpy' if use_numpy else 'pure python'}: {per_frame * 1e6:.1f} µs per frame "
+              f"({per_frame / (FRAME_MS / 1000):.3%} of one core in real time)")
+        print(f"  dropped {stats['dropped_share']:.0%} of frames, "
+              f"{stats['frames_dropped'] / 10 * message_bytes / 1024:.0f} KiB per minute not sent upstream")
+
+    # Local work a dropped frame saves besides the bytes: building its append message
+    started = time.perf_counter()
+    for payload in frames:
+        json.dumps({"type": "input_audio_buffer.append", "audio": payload})
+    print(f"serializing one append message: {(time.perf_counter() - started) / len(frames) * 1e6:.1f} µs")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,233 @@
+import os
+import json
+import asyncio
+import logging
+from datetime import datetime
+from typing import Dict, List, Set
+from availability import parse_date, parse_time
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Hard limit for a knowledge base lookup during a call, in seconds
+KNOWLEDGE_LOOKUP_TIMEOUT = float(os.getenv("KNOWLEDGE_LOOKUP_TIMEOUT", 0.8))
+# Passages returned to the model per lookup
+KNOWLEDGE_LOOKUP_RESULTS = 3
+# Alternatives offered when the requested time is taken
+AVAILABILITY_ALTERNATIVES = 3
+
+# Function tools registered on every realtime session (see send_session_update)
+TOOLS = [
+    {
+        "type": "function",
+        "name": "lookup_knowledge_base",
+        "description": (
+            "Search the company's knowledge base. Use it for any question about services, "
+            "prices, policies, procedures or opening hours before answering."
+        ),
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "query": {
+                    "type": "string",
+                    "description": "The caller's question, rephrased as a short search query",
+                },
+            },
+            "required": ["query"],
+        },
+    },
+    {
+        "type": "function",
+        "name": "check_availability",
+        "description": (
+            "Check whether an appointment time is free before agreeing to it. Without a time, "
+            "returns the free times of the day."
+        ),
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "date": {
+                    "type": "string",
+                    "description": "YYYY-MM-DD, or today, tomorrow or a weekday name as the caller said it",
+                },
+                "time": {
+                    "type": "string",
+                    "description": "24 hour HH:MM, leave out to list the free times of the day",
+                },
+            },
+            "required": ["date"],
+        },
+    },
+]
+
+
+def _passages(documents) -> List[str]:
+    return [document.page_content for document in documents[:KNOWLEDGE_LOOKUP_RESULTS]]
+
+
+def _retrieve(tenant, query: str):
+    return tenant.output().retriever.invoke(query)
+
+
+async def lookup_knowledge_base(tenant, query: str) -> dict:
+    """Passages for the query from the tenant's retriever, within the latency budget.
+
+    The hybrid retriever usually answers from the in-process BM25 index
+    without any network call. If it needs the vector store and that takes
+    too long, the lexical results alone are returned.
+    """
+    try:
+        # The first lookup also opens the vector store, off the event loop and within the budget
+        documents = await asyncio.wait_for(
+            asyncio.to_thread(_retrieve, tenant, query), timeout=KNOWLEDGE_LOOKUP_TIMEOUT
+        )
+        return {"results": _passages(documents)}
+    except asyncio.TimeoutError:
+        logger.warning(f"Knowledge lookup exceeded {KNOWLEDGE_LOOKUP_TIMEOUT}s, using lexical results")
+    except Exception as e:
+        logger.error(f"Error in knowledge lookup: {e}")
+
+    if tenant.lexical_index is None:
+        return {"results": [], "note": "The knowledge base is unavailable right now."}
+    hits = tenant.lexical_index.search(query, KNOWLEDGE_LOOKUP_RESULTS)
+    return {"results": [tenant.lexical_index.passages[doc_id] for doc_id, _, _ in hits]}
+
+
+def _times(slots) -> List[str]:
+    return [f"{slot:%A %Y-%m-%d %H:%M}" for slot in slots]
+
+
+def check_availability(tenant, date_text: str, time_text: str = None) -> dict:
+    """Free or taken for a time, or the free times of a day, from the tenant's interval index.
+
+    Answers from memory in microseconds, so unlike the knowledge lookup it
+    runs directly on the event loop.
+    """
+    store = tenant.appointments
+    now = datetime.now()
+    day = parse_date(date_text, now.date())
+    if day is None:
+        return {"error": f"Could not read the date {date_text!r}, ask the caller for the date again."}
+    result = {"today": f"{now:%A %Y-%m-%d}", "date": f"{day:%A %Y-%m-%d}"}
+
+    if not store.is_open(day):
+        result["closed"] = True
+        result["next_free_times"] = _times(store.next_free_slots(max(now, datetime.combine(day, store.opening)), AVAILABILITY_ALTERNATIVES))
+        return result
+
+    at = parse_time(time_text) if time_text else None
+    if at is None:
+        result["free_times"] = [f"{start:%H:%M}-{end:%H:%M}" for start, end in store.free_ranges(day, now)]
+        if not result["free_times"]:
+            result["next_free_times"] = _times(store.next_free_slots(max(now, datetime.combine(day, store.closing)), AVAILABILITY_ALTERNATIVES))
+        return result
+
+    start = datetime.combine(day, at)
+    result["time"] = f"{at:%H:%M}"
+    result["free"] = start >= now and store.is_free(start)
+    if not result["free"]:
+        result["alternatives"] = _times(store.next_free_slots(max(now, start), AVAILABILITY_ALTERNATIVES))
+    return result
+
+
+async def run_tool(tenant, item: dict) -> dict:
+    """Run the tool of a function_call item and return its result"""
+    name = item.get("name")
+    try:
+        arguments = json.loads(item.get("arguments") or "{}")
+    except json.JSONDecodeError:
+        arguments = {}
+
+    try:
+        if name == "lookup_knowledge_base":
+            result = await lookup_knowledge_base(tenant, arguments.get("query", ""))
+        elif name == "check_availability":
+            result = check_availability(tenant, arguments.get("date", ""), arguments.get("time"))
+        else:
+            result = {"error": f"Unknown tool {name}"}
+    except Exception as e:
+        logger.error(f"Tool {name} failed: {e}")
+        result = {"error": f"{name} failed"}
+    logger.info(f"Tool {name}({arguments}) -> {result}")
+    return result
+
+
+class ToolCalls:
+    """Tool calls of one realtime session, answered once their response is over.
+
+    Tools start from the function_call item of response.output_item.done,
+    the first event carrying name, call_id and arguments together (the
+    arguments.done event has no name), and at the latest from the output
+    of response.done. The API rejects
+    response.create while a response is still active. So the outputs of a
+    response's calls are held until its response.done, then sent together
+    with a single response.create. A cancelled response (the caller spoke
+    over it) still gets its outputs, the caller's new turn answers them.
+    """
+
+    def __init__(self, openai_ws, tenant):
+        self.openai_ws = openai_ws
+        self.tenant = tenant
+        # response_id -> {"calls": {call_id: task}, "done": event, "status": str}
+        self._responses: Dict[str, dict] = {}
+        self._tasks: Set[asyncio.Task] = set()
+
+    def _track(self, coro) -> asyncio.Task:
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    def _start(self, response_id: str, item: dict):
+        pending = self._responses.get(response_id)
+        if pending is None:
+            pending = self._responses[response_id] = {
+                "calls": {}, "done": asyncio.Event(), "status": None,
+            }
+            self._track(self._answer(response_id))
+        if item["call_id"] not in pending["calls"]:
+            pending["calls"][item["call_id"]] = self._track(run_tool(self.tenant, item))
+
+    def output_item_done(self, event: dict):
+        """response.output_item.done: start the tool of a function_call item"""
+        if event["item"].get("type") == "function_call":
+            self._start(event["response_id"], event["item"])
+
+    def response_done(self, event: dict):
+        """response.done: the outputs of its tool calls may now be sent"""
+        response = event["response"]
+        for item in response.get("output", []):
+            if item.get("type") == "function_call":
+                self._start(response["id"], item)
+        pending = self._responses.get(response["id"])
+        if pending is not None:
+            pending["status"] = response["status"]
+            pending["done"].set()
+
+    async def _answer(self, response_id: str):
+        pending = self._responses[response_id]
+        try:
+            await pending["done"].wait()
+            # response.done has started every call of the response
+            results = await asyncio.gather(*pending["calls"].values())
+        finally:
+            del self._responses[response_id]
+
+        if self.openai_ws.closed:
+            return
+        for call_id, result in zip(pending["calls"], results):
+            await self.openai_ws.send(json.dumps({
+                "type": "conversation.item.create",
+                "item": {
+                    "type": "function_call_output",
+                    "call_id": call_id,
+                    "output": json.dumps(result),
+                },
+            }))
+        if pending["status"] == "completed":
+            await self.openai_ws.send(json.dumps({"type": "response.create"}))
+
+    def cancel(self):
+        for task in self._tasks:
+            task.cancel()